@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Rough timings for constructing, formatting, and writing large diagrams.
+# Run as `python bench.py`; `python bench.py --help` for saving and comparing baselines.
+
+import argparse
+import json
+import sys
+import time
+
+import railroad
+
+
+def timed(label, fn, repeat=3, setup=None):
+    # The best of `repeat` runs of fn(), each given a fresh setup() result if there's a setup.
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            fn(arg)
+        else:
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<40} {best * 1000:10.1f} ms")
+    return best
+
+
+def benchBulkConstruction(sizes=(10_000, 100_000)):
+    print(f"NumPy: {'yes' if railroad._numpy() is not None else 'no'}")
+    for size in sizes:
+        texts = [f"keyword-{i}" for i in range(size)]
+        items = [railroad.Terminal(text) for text in texts]
+        print(f"-- {size} alternatives")
+        timed("Choice(0, *items)", lambda: railroad.Choice(0, *items))
+        timed("Choice.fromItems(0, items)", lambda: railroad.Choice.fromItems(0, items))
+        timed("Choice.fromItems(0, texts)", lambda: railroad.Choice.fromItems(0, texts))
+        timed("Sequence(*items)", lambda: railroad.Sequence(*items))
+        timed("Sequence.fromItems(items)", lambda: railroad.Sequence.fromItems(items))
+        timed("Stack(*items)", lambda: railroad.Stack(*items))
+        timed("Stack.fromItems(items)", lambda: railroad.Stack.fromItems(items))
+
+
+def syntheticEbnf(rules):
+    # A grammar where every rule mixes literals, references to later rules,
+    # alternation, grouping, and repetition.
+    lines = []
+    for i in range(rules):
+        a, b, c = (i + 1) % rules, (i + 7) % rules, (i + 13) % rules
+        lines.append(
+            f"[{i + 1}] rule{i} ::= 'kw{i}' (rule{a} | rule{b} '-' [a-z]+)* rule{c}? "
+            f"/* rule {i} */"
+        )
+    return "\n".join(lines)
+
+
+def benchEbnf(sizes=(1_000, 5_000)):
+    for size in sizes:
+        source = syntheticEbnf(size)
+        print(f"-- EBNF grammar with {size} rules ({len(source)} chars)")
+        timed("fromEbnf()", lambda: railroad.fromEbnf(source))
+
+
+# Generators for the shapes that are slowest to lay out, each taking a size
+# and returning a fresh Diagram.
+# The deep shapes run at the default recursion limit, like users' code does,
+# so scaling them up far enough shows where the library runs out of stack.
+
+
+def longSequence(n):
+    return railroad.Diagram(railroad.Sequence(*(f"item-{i}" for i in range(n))))
+
+
+def wideChoice(n):
+    return railroad.Diagram(railroad.Choice(n // 2, *(f"option-{i}" for i in range(n))))
+
+
+def wideMultipleChoice(n):
+    return railroad.Diagram(railroad.MultipleChoice(n // 2, "any", *(f"option-{i}" for i in range(n))))
+
+
+def wideHorizontalChoice(n):
+    return railroad.Diagram(railroad.HorizontalChoice(*(railroad.Choice(0, f"a-{i}", f"b-{i}") for i in range(n))))
+
+
+def deepOptional(n):
+    item = railroad.Terminal("core")
+    for i in range(n):
+        item = railroad.Optional(railroad.Sequence(f"level-{i}", item), skip=bool(i % 2))
+    return railroad.Diagram(item)
+
+
+def deepGroup(n):
+    item = railroad.Terminal("core")
+    for i in range(n):
+        item = railroad.Group(railroad.Sequence(item, f"level-{i}"), f"group {i}")
+    return railroad.Diagram(item)
+
+
+def tallStack(n):
+    return railroad.Diagram(railroad.Stack(*(railroad.Sequence(f"row-{i}", railroad.ZeroOrMore(f"rep-{i}")) for i in range(n))))
+
+
+def bigOptionalSequence(n):
+    return railroad.Diagram(railroad.OptionalSequence(*(f"part-{i}" for i in range(n))))
+
+
+SHAPES = {
+    "longSequence": (longSequence, 2_000),
+    "wideChoice": (wideChoice, 1_000),
+    "wideMultipleChoice": (wideMultipleChoice, 1_000),
+    "wideHorizontalChoice": (wideHorizontalChoice, 300),
+    "deepOptional": (deepOptional, 60),
+    "deepGroup": (deepGroup, 60),
+    "tallStack": (tallStack, 1_000),
+    "bigOptionalSequence": (bigOptionalSequence, 100),
+}
+
+
+def benchShapes(shapes=None, scale=1.0, repeat=3):
+    # Time each phase of each shape separately, returning {"shape[size].phase": seconds}.
+    results = {}
+    for name in shapes or SHAPES:
+        generate, size = SHAPES[name]
+        size = max(1, int(size * scale))
+        print(f"-- {name}({size})")
+
+        def formatted(generate=generate, size=size):
+            return generate(size).format()
+
+        def discard(_):
+            pass
+
+        phases = {
+            "construct": timed("construct", lambda generate=generate, size=size: generate(size), repeat),
+            "format": timed("format", lambda d: d.format(), repeat, setup=lambda generate=generate, size=size: generate(size)),
+            "writeSvg": timed("writeSvg", lambda d: d.writeSvg(discard), repeat, setup=formatted),
+            "writeStandalone": timed("writeStandalone", lambda d: d.writeStandalone(discard), repeat, setup=formatted),
+            "writeText": timed("writeText", lambda d: d.writeText(discard), repeat, setup=lambda generate=generate, size=size: generate(size)),
+        }
+        for phase, seconds in phases.items():
+            results[f"{name}[{size}].{phase}"] = seconds
+    return results
+
+
+def compareBaseline(results, baseline, threshold=1.25):
+    # Print how each timing compares to the baseline, returning the names of those that got slower by more than `threshold`.
+    regressions = []
+    print(f"-- compared to baseline (regression threshold {threshold:.2f}x)")
+    for key, seconds in results.items():
+        before = baseline.get(key)
+        if not before:
+            print(f"{key:<50} {'new':>10}")
+            continue
+        ratio = seconds / before
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key:<50} {ratio:9.2f}x{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark railroad-diagrams.")
+    parser.add_argument("suites", nargs="*", metavar="SUITE", help="Which of bulk, ebnf, and shapes to run. (Default: all.)")
+    parser.add_argument("--shape", action="append", choices=sorted(SHAPES), help="Only run these shapes.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every shape's size by this.")
+    parser.add_argument("--repeat", type=int, default=3, help="Take the best of this many runs. (Default: 3.)")
+    parser.add_argument("--save", metavar="FILE", help="Save the shape timings as a JSON baseline.")
+    parser.add_argument("--compare", metavar="FILE", help="Compare the shape timings against a saved baseline.")
+    parser.add_argument("--threshold", type=float, default=1.25, help="How much slower counts as a regression. (Default: 1.25.)")
+    args = parser.parse_args(argv)
+    suites = args.suites or ["bulk", "ebnf", "shapes"]
+    for suite in suites:
+        if suite not in ("bulk", "ebnf", "shapes"):
+            parser.error(f"unknown suite {suite!r}")
+
+    if "bulk" in suites:
+        benchBulkConstruction()
+    if "ebnf" in suites:
+        benchEbnf()
+    if "shapes" not in suites:
+        return 0
+    results = benchShapes(args.shape, args.scale, args.repeat)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as fh:
+            json.dump({"python": sys.version, "results": results}, fh, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)["results"]
+        if compareBaseline(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
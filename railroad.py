@@ -1,20 +1,44 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import itertools
+import json
 import math as Math
+import os
+import pickle
+import re
 import sys
+import threading
+import time
+import weakref
+
+try:
+    from re import _parser as sre_parse  # type: ignore[attr-defined,unused-ignore]
+except ImportError:
+    # Before 3.11, the regex parser was a top-level module.
+    import sre_parse  # pylint: disable=deprecated-module
 
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
+    import asyncio
+    from concurrent import futures
     from typing import (
         Any,
         Callable,
         Dict,
         Generator,
+        Iterable,
         List,
         Optional as Opt,
+        Protocol,
         Sequence as Seq,
+        Set,
         Tuple,
         Type,
         TypeVar,
@@ -26,6 +50,15 @@ if TYPE_CHECKING:
     WriterF = Callable[[str], Any]
     WalkerF = Callable[[DiagramItem], Any]  # pylint: disable=used-before-assignment
     AttrsT = Dict[str, Any]
+    OverlayT = Dict[Any, Union[str, AttrsT]]
+    PlacementT = Tuple["DiagramItem", float, float, float]
+    BoxT = Tuple["DiagramItem", float, float, float, float]
+
+    class RenderCacheT(Protocol):
+        # Where rendered output is cached; see RenderCache and DiskCache.
+        def get(self, key: str) -> Opt[str]: ...
+
+        def put(self, key: str, value: str) -> None: ...
 
 # Display constants
 DEBUG = False  # if true, writes some debug information into attributes
@@ -69,7 +102,38 @@ def doubleenumerate(seq: Seq[T]) -> Generator[Tuple[int, int, T], None, None]:
         yield i, i - length, item
 
 
+def expandPadding(
+    top: float, right: Opt[float], bottom: Opt[float], left: Opt[float]
+) -> Tuple[float, float, float, float]:
+    # Fills in omitted paddings like CSS does.
+    if right is None:
+        right = top
+    if bottom is None:
+        bottom = top
+    if left is None:
+        left = right
+    return top, right, bottom, left
+
+
+def _overlaidAttrs(attrs: AttrsT, extra: Union[str, AttrsT]) -> AttrsT:
+    # A string adds classes; a dict adds attributes,
+    # with any "class" in it added to the existing classes.
+    if isinstance(extra, str):
+        extra = {"class": extra}
+    merged = dict(attrs)
+    for name, value in extra.items():
+        if name == "class" and merged.get("class"):
+            merged["class"] = f"{merged['class'].rstrip()} {value}"
+        else:
+            merged[name] = value
+    return merged
+
+
 def addDebug(el: DiagramItem) -> None:
+    # Every item's constructor finishes by calling this, so it's also where construction is budgeted.
+    usage = _activeBudget.get()
+    if usage is not None:
+        usage.itemConstructed(el)
     if not DEBUG:
         return
     el.attrs["data-x"] = "{0} w:{1} h:{2}/{3}/{4}".format(
@@ -77,7 +141,82 @@ def addDebug(el: DiagramItem) -> None:
     )
 
 
+def _deepSize(obj: Any, seen: Set[int]) -> int:
+    # sys.getsizeof() of obj and everything it holds, apart from objects in `seen`
+    # and the diagram items and geometry it refers to (which are counted separately),
+    # adding everything it counts to `seen`.
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or o is not obj and isinstance(o, (DiagramItem, Path, Style, Fragment)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+    return size
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy() -> Any:
+    # NumPy is only used to speed up the bulk constructors (which fall back to plain Python),
+    # so it's imported the first time one of them is used, rather than with this module.
+    try:
+        import numpy  # type: ignore[import-not-found,unused-ignore]  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return numpy
+
+
+def _bulkMetrics(items: Seq[DiagramItem]) -> Opt[Tuple[List[Any], List[Any], List[Any], List[Any], List[bool]]]:
+    # Columns of (width, up, height, down, needsSpace) for the items, for the bulk constructors,
+    # or None if they should build the item item-by-item instead.
+    # The vertical measurements (and AR and VS) have to be ints:
+    # arithmetic on ints is exact, so adding them up in bulk (even as NumPy float64s)
+    # gives exactly the numbers the item-by-item constructors would,
+    # whereas floats can round differently depending on the order they're added in.
+    ups = [item.up for item in items]
+    heights = [item.height for item in items]
+    downs = [item.down for item in items]
+    types = {type(AR), type(VS)}
+    for column in (ups, heights, downs):
+        types.update(map(type, column))
+    if types != {int}:
+        return None
+    return ([item.width for item in items], ups, heights, downs, [item.needsSpace for item in items])
+
+
+class Visit:
+    # One step of DiagramItem.iterate():
+    # the item, its parent item (None for the starting item),
+    # its path from the starting item (a tuple of indexes into each parent's _subItems(),
+    # the same paths overlays accept), and its depth (the path's length).
+    def __init__(self, item: DiagramItem, parent: Opt[DiagramItem], path: Tuple[int, ...]):
+        self.item = item
+        self.parent = parent
+        self.path = path
+        self.depth = len(path)
+        self.skipped = False
+
+    def skipChildren(self) -> None:
+        # In a pre-order iteration, don't go into this item's children.
+        self.skipped = True
+
+    def __repr__(self) -> str:
+        return f"Visit({self.item!r}, path={self.path})"
+
+
 class DiagramItem:
+    _fingerprint: Opt[str] = None
+    # Only tracked while a Budget with a maxDepth is being enforced.
+    _depth: int = 0
+
     def __init__(self, name: str, attrs: Opt[AttrsT] = None, text: Opt[Node] = None):
         self.name = name
         # up = distance it projects above the entry line
@@ -95,7 +234,7 @@ class DiagramItem:
         self.attrs: AttrsT = attrs or {}
         # Subclasses store their meaningful children as .item or .items;
         # .children instead stores their formatted SVG nodes.
-        self.children: List[Union[Node, Path, Style]] = [text] if text else []
+        self.children: List[Union[Node, Path, Style, Fragment]] = [text] if text else []
 
     def format(self, x: float, y: float, width: float) -> DiagramItem:
         raise NotImplementedError  # Virtual
@@ -107,22 +246,285 @@ class DiagramItem:
         parent.children.append(self)
         return self
 
-    def writeSvg(self, write: WriterF) -> None:
+    def formatterFor(self, item: DiagramItem) -> Callable[[float, float, float], DiagramItem]:
+        # The function that formats one of this item's children, to be called with (x, y, width)
+        # and added to this item's SVG.
+        # Usually that's just the child's .format(); it's returned rather than called here
+        # so that formatting a deep tree takes no extra stack frames.
+        # When the diagram is being formatted with a FragmentCache,
+        # the child is instead drawn relative to its own origin,
+        # serialized once per (structure, width),
+        # and translated into place.
+        # When a Budget is being enforced, formatting it is also counted against it.
+        cache = _activeFragmentCache.get()
+        usage = _activeBudget.get()
+        if cache is None and usage is None:
+            return item.format
+
+        def format(x: float, y: float, width: float) -> DiagramItem:
+            if usage is not None:
+                usage.layoutDepth += 1
+            try:
+                if usage is not None:
+                    usage.itemFormatted()
+                if cache is None:
+                    return item.format(x, y, width)
+                g = DiagramItem("g", {"transform": f"translate({x} {y})"})
+                Fragment(cache.render(item, width)).addTo(g)
+                return g
+            finally:
+                if usage is not None:
+                    usage.layoutDepth -= 1
+
+        return format
+
+    def textDiagrammerFor(self, item: DiagramItem) -> Callable[[], TextDiagram]:
+        # The function that lays out one of this item's children as text.
+        # Like formatterFor(), that's usually just the child's .textDiagram(),
+        # returned rather than called so that a deep tree takes no extra stack frames.
+        # When a Budget is being enforced, laying it out is counted against it.
+        usage = _activeBudget.get()
+        if usage is None:
+            return item.textDiagram
+
+        def textDiagram() -> TextDiagram:
+            usage.layoutDepth += 1
+            try:
+                usage.itemFormatted()
+                return item.textDiagram()
+            finally:
+                usage.layoutDepth -= 1
+
+        return textDiagram
+
+    def fingerprint(self) -> str:
+        # A digest of the item's structure;
+        # identically-built items have identical fingerprints.
+        # Items aren't changed after construction, so it's computed once.
+        # The items below are fingerprinted first, bottom-up with an explicit stack,
+        # so each _fingerprintSource() only has to look one level down.
+        stack: List[Tuple[DiagramItem, bool]] = [(self, False)]
+        while stack:
+            item, childrenDone = stack.pop()
+            if item._fingerprint is not None:
+                continue
+            if childrenDone:
+                source = item._fingerprintSource()
+                item._fingerprint = hashlib.sha1(source.encode("utf-8")).hexdigest()
+            else:
+                stack.append((item, True))
+                stack.extend((child, False) for child in item._subItems())
+        assert self._fingerprint is not None
+        return self._fingerprint
+
+    def _fingerprintSource(self) -> str:
+        # Leaves have no children, so their repr() describes them completely.
+        return repr(self)
+
+    def _subItems(self) -> List[DiagramItem]:
+        # The items this item was constructed from, in order.
+        # (Unlike .children, which holds the formatted SVG.)
+        return []
+
+    def toDict(self) -> Dict[str, Any]:
+        # A JSON-compatible description of the item, which fromDict() can rebuild it from.
+        # Built bottom-up with an explicit stack, so deep trees don't hit the recursion limit.
+        results: List[Dict[str, Any]] = []
+        stack: List[Tuple[DiagramItem, bool]] = [(self, False)]
+        while stack:
+            item, childrenDone = stack.pop()
+            subItems = item._subItems()
+            if childrenDone:
+                children = results[len(results) - len(subItems) :] if subItems else []
+                del results[len(results) - len(subItems) :]
+                results.append(item._toDict(children))
+            else:
+                stack.append((item, True))
+                stack.extend((child, False) for child in reversed(subItems))
+        return results[0]
+
+    def toJson(self) -> str:
+        return json.dumps(self.toDict(), separators=(",", ":"))
+
+    def memoryReport(self) -> Dict[str, Any]:
+        """
+        Roughly how much memory this item's tree takes up, from sys.getsizeof(),
+        as {"tree": ..., "attrs": ..., "geometry": ..., "bytes": ...}.
+
+        "tree" is the logical items themselves (with their text, item lists, and other fields),
+        "attrs" is their SVG attribute dicts,
+        and "geometry" is everything in their formatted children (Paths, wrapper <g>s, text, and the lists holding them);
+        each maps a class name to [object count, bytes].
+        "bytes" gives the totals of each part, and "total".
+        Objects shared between items (like interned strings) are only counted once.
+        """
+        items: List[DiagramItem] = []
+        stack: List[DiagramItem] = [self]
+        while stack:
+            item = stack.pop()
+            items.append(item)
+            stack.extend(item._subItems())
+        itemIds = {id(item) for item in items}
+        # Set aside the attrs and children, so they're not counted as part of the tree.
+        seen = {id(item.attrs) for item in items} | {id(item.children) for item in items}
+
+        def tally(part: Dict[str, List[int]], name: str, size: int) -> None:
+            entry = part.setdefault(name, [0, 0])
+            entry[0] += 1
+            entry[1] += size
+
+        tree: Dict[str, List[int]] = {}
+        for item in items:
+            tally(tree, type(item).__name__, _deepSize(item, seen))
+        attrs: Dict[str, List[int]] = {}
+        for item in items:
+            seen.discard(id(item.attrs))
+            tally(attrs, type(item).__name__, _deepSize(item.attrs, seen))
+        geometry: Dict[str, List[int]] = {}
+        pending: List[Any] = []
+        for item in items:
+            if item.children:
+                seen.discard(id(item.children))
+                tally(geometry, "children list", _deepSize(item.children, seen))
+                pending.extend(item.children)
+        while pending:
+            obj = pending.pop()
+            if id(obj) in itemIds or id(obj) in seen:
+                continue
+            tally(geometry, type(obj).__name__, _deepSize(obj, seen))
+            if isinstance(obj, DiagramItem):
+                pending.extend(obj.children)
+
+        sizes = {name: sum(size for _, size in part.values()) for name, part in (("tree", tree), ("attrs", attrs), ("geometry", geometry))}
+        sizes["total"] = sum(sizes.values())
+        return {"tree": tree, "attrs": attrs, "geometry": geometry, "bytes": sizes}
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        # Pickle only the constructor arguments (.toDict()'s fields, but holding the child items
+        # themselves), not the attrs or any formatted children.
+        # Anything that wouldn't be rebuilt as the same class (plain elements, and subclasses) pickles normally.
+        if type(self) not in DICT_CLASSES:
+            return object.__reduce_ex__(self, protocol)
+        return (_unpickleItem, (self._toDict(self._subItems()),))
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        # The item's own description, given one for each of its _subItems():
+        # their dicts, or (when pickling or rebuilding) the child items themselves.
+        raise TypeError(f"Plain {self.name} elements can't be serialized.")
+
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        # The (item, x, y, width) that .format(x, y, width)
+        # would format each of this item's children at,
+        # without drawing anything.
+        return []
+
+    def writeSvg(self, write: WriterF, overlay: Opt[OverlayT] = None) -> None:
+        attrs = self.attrs
+        if overlay:
+            extra = overlay.get(self)
+            if extra is not None:
+                attrs = _overlaidAttrs(attrs, extra)
         write("<{0}".format(self.name))
-        for name, value in sorted(self.attrs.items()):
+        for name, value in sorted(attrs.items()):
             write(' {0}="{1}"'.format(name, escapeAttr(value)))
         write(">")
         if self.name in ["g", "svg"]:
             write("\n")
         for child in self.children:
-            if isinstance(child, (DiagramItem, Path, Style)):
+            if isinstance(child, DiagramItem):
+                child.writeSvg(write, overlay)
+            elif isinstance(child, (Path, Style, Fragment)):
                 child.writeSvg(write)
             else:
                 write(escapeHtml(child))
         write("</{0}>".format(self.name))
 
     def walk(self, cb: WalkerF) -> None:
-        cb(self)
+        for visit in self.iterate():
+            cb(visit.item)
+
+    def iterate(self, order: str = "pre") -> Generator[Visit, None, None]:
+        """
+        Yields a Visit for this item and every item in it,
+        in "pre" order (each item before its children) or "post" order (after them).
+        Uses an explicit stack, so deep trees don't hit the recursion limit.
+
+        In pre order, calling .skipChildren() on a Visit before asking for the next one
+        skips everything inside that item.
+        """
+        if order not in ("pre", "post"):
+            raise ValueError(f"Unknown order {order!r}; expected 'pre' or 'post'.")
+        stack: List[Tuple[Visit, bool]] = [(Visit(self, None, ()), False)]
+        while stack:
+            visit, childrenDone = stack.pop()
+            if childrenDone:
+                yield visit
+                continue
+            if order == "pre":
+                yield visit
+                if visit.skipped:
+                    continue
+            else:
+                stack.append((visit, True))
+            item = visit.item
+            subItems = item._subItems()
+            for i in range(len(subItems) - 1, -1, -1):
+                stack.append((Visit(subItems[i], item, visit.path + (i,)), False))
+
+    def transform(
+        self,
+        fn: Callable[[DiagramItem], Opt[Node]],
+        prune: Opt[Callable[[DiagramItem], bool]] = None,
+    ) -> DiagramItem:
+        """
+        Rewrites the tree bottom-up, returning the new tree.
+
+        fn is called on each item after its children have been transformed,
+        and returns its replacement (or None, or the item itself, to keep it).
+        Every item is rebuilt rather than reused, even where nothing below it was replaced,
+        since formatting draws into the items themselves,
+        so an item shared between the two trees would be drawn into twice.
+        (Items of classes that can't be rebuilt, like plain elements, are reused if nothing inside them changed.)
+        If prune(item) returns true, that item's children are copied but not transformed.
+        An item that appears in the tree several times is only transformed once.
+        """
+        done: Dict[int, DiagramItem] = {}
+        stack: List[Tuple[DiagramItem, bool, bool]] = [(self, False, True)]
+        while stack:
+            original, childrenDone, transforming = stack.pop()
+            if id(original) in done:
+                continue
+            subItems = original._subItems()
+            if not childrenDone and subItems:
+                stack.append((original, True, transforming))
+                transformChildren = transforming and (prune is None or not prune(original))
+                stack.extend((child, False, transformChildren) for child in reversed(subItems) if id(child) not in done)
+                continue
+            newItems = [done[id(child)] for child in subItems]
+            item = original
+            if type(original) in DICT_CLASSES or any(new is not old for new, old in zip(newItems, subItems)):
+                item = original._withSubItems(newItems)
+            result = fn(item) if transforming else None
+            done[id(original)] = item if result is None else wrapString(result)
+        return done[id(self)]
+
+    def normalize(self, leftFactor: bool = False) -> DiagramItem:
+        """
+        Returns a simpler tree describing the same language, with
+        nested Sequences flattened, Skips dropped from Sequences,
+        nested Choices merged, duplicate alternatives (like the extra Skip of an Optional(Optional(x))) removed,
+        and Sequences and Choices of one item replaced by that item.
+        With leftFactor, Choice alternatives starting with the same items are also combined,
+        so Choice(0, Sequence('a', 'b'), Sequence('a', 'c')) becomes Sequence('a', Choice(0, 'b', 'c')).
+        As with .transform(), the result is a new tree, sharing no items with the original.
+        """
+        return self.transform(lambda item: _normalized(item, leftFactor))
+
+    def _withSubItems(self, subItems: List[DiagramItem]) -> DiagramItem:
+        # A copy of this item, built with the same arguments except for its _subItems().
+        if type(self) not in DICT_CLASSES:
+            raise TypeError(f"Can't rebuild a {type(self).__name__} with new children.")
+        return _unpickleItem(self._toDict(subItems))
 
     def __repr__(self) -> str:
         return f"DiagramItem({self.name}, {self.attrs}, {self.children})"
@@ -142,15 +544,24 @@ class DiagramMultiContainer(DiagramItem):
     def format(self, x: float, y: float, width: float) -> DiagramItem:
         raise NotImplementedError  # Virtual
 
-    def walk(self, cb: WalkerF) -> None:
-        cb(self)
-        for item in self.items:
-            item.walk(cb)
+    def _subItems(self) -> List[DiagramItem]:
+        return self.items
+
+    def _fingerprintSource(self) -> str:
+        items = ",".join(item.fingerprint() for item in self.items)
+        return f"{type(self).__name__}({items})"
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": type(self).__name__, "items": subItems}
 
     def __repr__(self) -> str:
         return f"DiagramMultiContainer({self.name}, {self.items}. {self.attrs}, {self.children})"
 
 
+# The drawing commands in a path's "d" (that is, everything but moves).
+PATH_COMMANDS = re.compile(r"[LlHhVvAaCcSsQqTtZz]")
+
+
 class Path:
     def __init__(self, x: float, y: float):
         self.x = x
@@ -322,6 +733,193 @@ class Style:
         write("<style>{cdata}</style>".format(cdata=cdata))
 
 
+class Fragment:
+    # Already-serialized SVG, from a FragmentCache.
+    def __init__(self, svg: str):
+        self.svg = svg
+
+    def __repr__(self) -> str:
+        return f"Fragment({repr(self.svg)})"
+
+    def addTo(self, parent: DiagramItem) -> Fragment:
+        parent.children.append(self)
+        return self
+
+    def writeSvg(self, write: WriterF) -> None:
+        write(self.svg)
+
+
+def configKey() -> Tuple[Any, ...]:
+    # All the module-level options that affect rendered output,
+    # for keying caches of rendered output.
+    return (
+        DEBUG,
+        VS,
+        AR,
+        DIAGRAM_CLASS,
+        STROKE_ODD_PIXEL_LENGTH,
+        INTERNAL_ALIGNMENT,
+        CHAR_WIDTH,
+        COMMENT_CHAR_WIDTH,
+        ESCAPE_HTML,
+        DEFAULT_STYLE,
+        tuple(sorted(TextDiagram.parts.items())),
+    )
+
+
+class FragmentCache:
+    # Rendered SVG for subtrees, drawn relative to their own origin,
+    # keyed by the subtree's fingerprint and the width it was formatted at.
+    # Pass one to Diagram.format() and share it across a whole grammar,
+    # so subexpressions that repeat between diagrams are only serialized once.
+    def __init__(self) -> None:
+        self.fragments: Dict[Tuple[str, float, Tuple[Any, ...]], str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.fragments)
+
+    def render(self, item: DiagramItem, width: float) -> str:
+        key = (item.fingerprint(), width, configKey())
+        svg = self.fragments.get(key)
+        if svg is not None:
+            self.hits += 1
+            return svg
+        self.misses += 1
+        # The item may already be formatted as part of another diagram,
+        # so draw it into a fresh children list, and put the old one back afterwards.
+        children = item.children
+        item.children = []
+        try:
+            item.format(0, 0, width)
+            chunks: List[str] = []
+            item.writeSvg(chunks.append)
+        finally:
+            item.children = children
+        svg = self.fragments[key] = "".join(chunks)
+        return svg
+
+
+# The FragmentCache that the diagram currently being formatted is using, if any.
+_activeFragmentCache: contextvars.ContextVar[Opt[FragmentCache]] = contextvars.ContextVar(
+    "_activeFragmentCache", default=None
+)
+
+
+class BudgetExceeded(ValueError):
+    # Raised as soon as a diagram goes over one of the active Budget's limits.
+    def __init__(self, limit: str, value: float, maximum: float):
+        ValueError.__init__(self, limit, value, maximum)
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+    def __str__(self) -> str:
+        return f"Diagram is over its {self.limit} budget ({self.value} > {self.maximum})."
+
+
+class Budget:
+    """
+    Limits on how much work a diagram can cause, for handling untrusted input.
+    Any limit left as None isn't enforced.
+
+    Inside `with budget.enforce():`, the limits are checked as the work happens,
+    raising BudgetExceeded as soon as one is passed:
+    maxNodes and maxTextLength (of any text, title, or label) as each item is constructed,
+    maxDepth as items are constructed and again as they're laid out (as SVG or as text),
+    maxNodes again during layout (for items that were built earlier),
+    maxWidth and maxHeight before a Diagram is laid out as SVG,
+    and maxBytes as text is laid out and as output is written.
+    fromRegex() doesn't use its cache while a Budget is enforced,
+    so the items it builds are always counted.
+    A Budget can be enforced in several threads or tasks at once; each gets its own count.
+    """
+
+    def __init__(
+        self,
+        maxNodes: Opt[int] = None,
+        maxDepth: Opt[int] = None,
+        maxTextLength: Opt[int] = None,
+        maxWidth: Opt[float] = None,
+        maxHeight: Opt[float] = None,
+        maxBytes: Opt[int] = None,
+    ):
+        self.maxNodes = maxNodes
+        self.maxDepth = maxDepth
+        self.maxTextLength = maxTextLength
+        self.maxWidth = maxWidth
+        self.maxHeight = maxHeight
+        self.maxBytes = maxBytes
+
+    @contextlib.contextmanager
+    def enforce(self) -> Generator[BudgetUsage, None, None]:
+        usage = BudgetUsage(self)
+        token = _activeBudget.set(usage)
+        try:
+            yield usage
+        finally:
+            _activeBudget.reset(token)
+
+
+class BudgetUsage:
+    # How much of a Budget has been used so far, within one enforce() block.
+    def __init__(self, budget: Budget):
+        self.budget = budget
+        self.constructed = 0
+        self.formatted = 0
+        self.layoutDepth = 0
+        self.bytes = 0
+
+    def check(self, limit: str, value: float, maximum: Opt[float]) -> None:
+        if maximum is not None and value > maximum:
+            raise BudgetExceeded(limit, value, maximum)
+
+    def itemConstructed(self, item: DiagramItem) -> None:
+        budget = self.budget
+        self.constructed += 1
+        self.check("node count", self.constructed, budget.maxNodes)
+        if budget.maxTextLength is not None:
+            for text in (getattr(item, "text", None), getattr(item, "title", None), getattr(item, "label", None)):
+                if isinstance(text, str):
+                    self.check("text length", len(text), budget.maxTextLength)
+        if budget.maxDepth is not None:
+            item._depth = 1 + max((child._depth for child in item._subItems()), default=0)
+            self.check("depth", item._depth, budget.maxDepth)
+
+    def itemFormatted(self) -> None:
+        self.formatted += 1
+        self.check("node count", self.formatted, self.budget.maxNodes)
+        self.check("depth", self.layoutDepth, self.budget.maxDepth)
+
+    def textLaidOut(self, text: TextDiagram) -> None:
+        # Every piece of a text diagram, as it's built up, ends up inside the whole thing,
+        # so once a piece is bigger than maxBytes, the output will be too.
+        # (Every character is at least a byte, and every line ends in a newline.)
+        self.check("output size", (text.width + 1) * text.height, self.budget.maxBytes)
+
+    def writer(self, write: WriterF) -> WriterF:
+        if self.budget.maxBytes is None:
+            return write
+
+        def countingWrite(text: str) -> Any:
+            self.bytes += len(text.encode("utf-8"))
+            self.check("output size", self.bytes, self.budget.maxBytes)
+            return write(text)
+
+        return countingWrite
+
+
+# The BudgetUsage of the Budget being enforced, if any.
+_activeBudget: contextvars.ContextVar[Opt[BudgetUsage]] = contextvars.ContextVar("_activeBudget", default=None)
+
+
+def budgetedWriter(write: WriterF) -> WriterF:
+    # The writer, counting its output against the active Budget's maxBytes, if there is one.
+    usage = _activeBudget.get()
+    return write if usage is None else usage.writer(write)
+
+
 class Diagram(DiagramMultiContainer):
     def __init__(self, *items: Node, **kwargs: str):
         # Accepts a type=[simple|complex] kwarg
@@ -355,6 +953,21 @@ class Diagram(DiagramMultiContainer):
             self.width -= 10
         self.formatted = False
 
+    def _fingerprintSource(self) -> str:
+        return f"type={self.type};" + DiagramMultiContainer._fingerprintSource(self)
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        # Includes the Start and End, so explicit (labeled) ones round-trip.
+        return {"kind": "Diagram", "type": self.type, "items": subItems}
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        # Rather than its geometry, a formatted Diagram sends the padding it was formatted with,
+        # and is formatted again after unpickling.
+        if type(self) is not Diagram:
+            return object.__reduce_ex__(self, protocol)
+        padding = self.padding if self.formatted else None
+        return (_unpickleItem, (self._toDict(self.items), padding))
+
     def __repr__(self) -> str:
         items = ", ".join(map(repr, self.items[1:-1]))
         pieces = [] if not items else [items]
@@ -368,63 +981,217 @@ class Diagram(DiagramMultiContainer):
         paddingRight: Opt[float] = None,
         paddingBottom: Opt[float] = None,
         paddingLeft: Opt[float] = None,
+        cache: Opt[FragmentCache] = None,
     ) -> Diagram:
-        if paddingRight is None:
-            paddingRight = paddingTop
-        if paddingBottom is None:
-            paddingBottom = paddingTop
-        if paddingLeft is None:
-            paddingLeft = paddingRight
-        assert paddingRight is not None
-        assert paddingBottom is not None
-        assert paddingLeft is not None
+        paddingTop, paddingRight, paddingBottom, paddingLeft = expandPadding(
+            paddingTop, paddingRight, paddingBottom, paddingLeft
+        )
+        usage = _activeBudget.get()
+        if usage is not None:
+            usage.check("width", self.width + paddingLeft + paddingRight, usage.budget.maxWidth)
+            usage.check("height", self.up + self.height + self.down + paddingTop + paddingBottom, usage.budget.maxHeight)
         x = paddingLeft
         y = paddingTop + self.up
         g = DiagramItem("g")
         if STROKE_ODD_PIXEL_LENGTH:
             g.attrs["transform"] = "translate(.5 .5)"
-        for item in self.items:
-            if item.needsSpace:
-                Path(x, y).h(10).addTo(g)
-                x += 10
-            item.format(x, y, item.width).addTo(g)
-            x += item.width
-            y += item.height
-            if item.needsSpace:
-                Path(x, y).h(10).addTo(g)
-                x += 10
+        token = _activeFragmentCache.set(cache)
+        try:
+            for item in self.items:
+                if item.needsSpace:
+                    Path(x, y).h(10).addTo(g)
+                    x += 10
+                g.formatterFor(item)(x, y, item.width).addTo(g)
+                x += item.width
+                y += item.height
+                if item.needsSpace:
+                    Path(x, y).h(10).addTo(g)
+                    x += 10
+        finally:
+            _activeFragmentCache.reset(token)
         self.attrs["width"] = str(self.width + paddingLeft + paddingRight)
         self.attrs["height"] = str(
             self.up + self.height + self.down + paddingTop + paddingBottom
         )
         self.attrs["viewBox"] = f"0 0 {self.attrs['width']} {self.attrs['height']}"
         g.addTo(self)
+        self.padding = (paddingTop, paddingRight, paddingBottom, paddingLeft)
         self.formatted = True
         return self
 
+    def stats(self) -> Dict[str, Any]:
+        """
+        Complexity statistics for the diagram, formatting it first if it isn't already:
+        the count of each type of item ("nodes", and "nodeCount" in total),
+        the deepest nesting of items below the Diagram ("maxDepth"),
+        the number of drawing commands in all its paths ("pathSegments"),
+        the size of the <svg> ("width" and "height"),
+        and the UTF-8 size of .writeSvg()'s output ("bytes").
+
+        Everything but the byte count comes from one walk over the items and their geometry;
+        the byte count is from serializing the diagram into a counter, without keeping the output.
+        """
+        if not self.formatted:
+            self.format()
+        nodes: Dict[str, int] = {}
+        maxDepth = 0
+        segments = 0
+        stack: List[Tuple[DiagramItem, int]] = [(self, 0)]
+        while stack:
+            item, depth = stack.pop()
+            nodes[type(item).__name__] = nodes.get(type(item).__name__, 0) + 1
+            maxDepth = max(maxDepth, depth)
+            stack.extend((child, depth + 1) for child in item._subItems())
+            # The item's own geometry, down to (but not into) the items inside it.
+            geometry: List[Any] = [item]
+            while geometry:
+                element = geometry.pop()
+                if isinstance(element, (Path, DiagramItem)) and "d" in element.attrs:
+                    segments += len(PATH_COMMANDS.findall(element.attrs["d"]))
+                if isinstance(element, DiagramItem):
+                    # Plain DiagramItems are wrapper elements; subclasses are the items inside.
+                    geometry.extend(child for child in element.children if type(child) in (Path, DiagramItem))
+        size = 0
+
+        def count(text: str) -> None:
+            nonlocal size
+            size += len(text.encode("utf-8"))
+
+        self.writeSvg(count)
+        return {
+            "nodes": nodes,
+            "nodeCount": sum(nodes.values()),
+            "maxDepth": maxDepth,
+            "pathSegments": segments,
+            "width": float(self.attrs["width"]),
+            "height": float(self.attrs["height"]),
+            "bytes": size,
+        }
+
+    def measure(
+        self,
+        paddingTop: float = 20,
+        paddingRight: Opt[float] = None,
+        paddingBottom: Opt[float] = None,
+        paddingLeft: Opt[float] = None,
+        boxes: bool = False,
+    ) -> Tuple[float, float, List[BoxT]]:
+        # The width and height that .format() with the same padding would give the <svg>,
+        # plus, if boxes is true, the (item, x, y, width, height) bounding box of every item,
+        # without generating any of the diagram's geometry.
+        paddingTop, paddingRight, paddingBottom, paddingLeft = expandPadding(
+            paddingTop, paddingRight, paddingBottom, paddingLeft
+        )
+        width = self.width + paddingLeft + paddingRight
+        height = self.up + self.height + self.down + paddingTop + paddingBottom
+        if not boxes:
+            return width, height, []
+        itemBoxes: List[BoxT] = [(self, paddingLeft, paddingTop, self.width, self.up + self.height + self.down)]
+        x = paddingLeft
+        y = paddingTop + self.up
+        placements = []
+        for item in self.items:
+            if item.needsSpace:
+                x += 10
+            placements.append((item, x, y, item.width))
+            x += item.width
+            y += item.height
+            if item.needsSpace:
+                x += 10
+        # Walk the tree with an explicit stack, so deep diagrams don't hit the recursion limit.
+        placements.reverse()
+        while placements:
+            item, x, y, itemWidth = placements.pop()
+            leftGap, _ = determineGaps(itemWidth, item.width)
+            itemBoxes.append((item, x + leftGap, y - item.up, item.width, item.up + item.height + item.down))
+            placements.extend(reversed(item._layoutChildren(x, y, itemWidth)))
+        return width, height, itemBoxes
+
     def textDiagram(self) -> TextDiagram:
         (separator, ) = TextDiagram._getParts(["separator"])
-        diagramTD = self.items[0].textDiagram()
+        diagramTD = self.textDiagrammerFor(self.items[0])()
         for item in self.items[1:]:
-            itemTD = item.textDiagram()
+            itemTD = self.textDiagrammerFor(item)()
             if item.needsSpace:
                 itemTD = itemTD.expand(1, 1, 0, 0)
             diagramTD = diagramTD.appendRight(itemTD, separator)
         return diagramTD
 
-    def writeSvg(self, write: WriterF) -> None:
+    def writeSvg(
+        self, write: WriterF, overlay: Opt[OverlayT] = None, cache: Opt[RenderCacheT] = None
+    ) -> None:
+        if cache is not None and not overlay:
+            self._writeCached(write, cache, f"svg;padding={self._outputPadding()}", self.writeSvg)
+            return
         if not self.formatted:
             self.format()
-        return DiagramItem.writeSvg(self, write)
+        return DiagramItem.writeSvg(self, budgetedWriter(write), self.resolveOverlay(overlay))
+
+    def _outputPadding(self) -> Tuple[float, float, float, float]:
+        # The padding the SVG is (or, when written, will be) formatted with.
+        return self.padding if self.formatted else expandPadding(20, None, None, None)
+
+    def _writeCached(self, write: WriterF, cache: RenderCacheT, kind: str, produce: Callable[[WriterF], None]) -> None:
+        # Write the output from the cache if it's there; otherwise produce it, and cache it.
+        key = renderKey(self, kind)
+        output = cache.get(key)
+        if output is None:
+            # Producing it counts against any budget, so writing it out doesn't count again.
+            chunks: List[str] = []
+            produce(chunks.append)
+            output = "".join(chunks)
+            cache.put(key, output)
+        else:
+            write = budgetedWriter(write)
+        write(output)
 
-    def writeText(self, write: WriterF) -> None:
+    def resolveOverlay(self, overlay: Opt[OverlayT]) -> Opt[OverlayT]:
+        # Overlays can be keyed by the items themselves,
+        # or by their path from the diagram:
+        # a tuple of indexes into each container's items
+        # (or [item, repeat] for OneOrMore, and [item, label] for Group).
+        if not overlay:
+            return None
+        resolved: OverlayT = {}
+        for key, extra in overlay.items():
+            if isinstance(key, tuple):
+                item: DiagramItem = self
+                for depth, index in enumerate(key):
+                    subItems = item._subItems()
+                    if not isinstance(index, int) or not 0 <= index < len(subItems):
+                        raise ValueError(
+                            f"Overlay path {key} doesn't exist: {type(item).__name__} at {key[:depth]} has {len(subItems)} items."
+                        )
+                    item = subItems[index]
+                key = item
+            resolved[key] = extra
+        return resolved
+
+    def writeText(self, write: WriterF, cache: Opt[RenderCacheT] = None) -> None:
+        if cache is not None:
+            self._writeCached(write, cache, "text", self.writeText)
+            return
         output = self.textDiagram()
         output = "\n".join(output.lines) + "\n"
         if ESCAPE_HTML:
             output = output.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
-        write(output)
+        budgetedWriter(write)(output)
 
-    def writeStandalone(self, write: WriterF, css: str | None = None) -> None:
+    def writeStandalone(
+        self,
+        write: WriterF,
+        css: str | None = None,
+        overlay: Opt[OverlayT] = None,
+        cache: Opt[RenderCacheT] = None,
+    ) -> None:
+        if cache is not None and not overlay:
+            self._writeCached(
+                write,
+                cache,
+                f"standalone;padding={self._outputPadding()};css={css!r}",
+                lambda w: self.writeStandalone(w, css),
+            )
+            return
         if not self.formatted:
             self.format()
         if css is None:
@@ -432,10 +1199,167 @@ class Diagram(DiagramMultiContainer):
         Style(css).addTo(self)
         self.attrs["xmlns"] = "http://www.w3.org/2000/svg"
         self.attrs['xmlns:xlink'] = "http://www.w3.org/1999/xlink"
-        DiagramItem.writeSvg(self, write)
-        self.children.pop()
-        del self.attrs["xmlns"]
-        del self.attrs["xmlns:xlink"]
+        try:
+            DiagramItem.writeSvg(self, budgetedWriter(write), self.resolveOverlay(overlay))
+        finally:
+            # Leave the diagram as it was, even if a Budget stopped the write partway.
+            self.children.pop()
+            del self.attrs["xmlns"]
+            del self.attrs["xmlns:xlink"]
+
+    @classmethod
+    def fitToWidth(
+        cls,
+        maxWidth: float,
+        *items: Node,
+        type: str = "simple",
+        padding: float = 20,
+        horizontalChoices: bool = False,
+    ) -> Diagram:
+        # Lays out the items as a single row if they fit,
+        # otherwise breaks them into a Stack of Sequence rows,
+        # choosing the breaks that give the shortest diagram
+        # (and, among equally tall ones, the most even rows).
+        # If horizontalChoices is true, top-level Choices
+        # are also turned into HorizontalChoices
+        # wherever that makes a row shorter and it still fits.
+        wrapped = [wrapString(item) for item in items]
+        start = wrapped.pop(0) if wrapped and isinstance(wrapped[0], Start) else Start(type)
+        end = wrapped.pop() if wrapped and isinstance(wrapped[-1], End) else End(type)
+        if not wrapped:
+            return cls(start, end, type=type)
+        # Everything in the diagram's width that isn't the middle item(s).
+        frame = start.width + end.width + padding * 2
+
+        def horizontal(row: List[DiagramItem], limit: float) -> List[DiagramItem]:
+            # Greedily swap Choices for HorizontalChoices while the row still fits.
+            metrics = _rowMetrics(row)
+            for i, item in enumerate(row):
+                if not isinstance(item, Choice):
+                    continue
+                trial = row[:i] + [HorizontalChoice(*item.items)] + row[i + 1 :]
+                trialMetrics = _rowMetrics(trial)
+                if trialMetrics[0] <= limit and _rowExtent(trialMetrics) < _rowExtent(metrics):
+                    row, metrics = trial, trialMetrics
+            return row
+
+        # First, see if everything fits on one line without a Stack.
+        # (A Diagram doesn't trim the outer spacing like a Sequence does.)
+        lineLimit = maxWidth - frame
+        lineLimit -= (10 if wrapped[0].needsSpace else 0) + (10 if wrapped[-1].needsSpace else 0)
+        if _rowMetrics(wrapped)[0] <= lineLimit:
+            if horizontalChoices:
+                wrapped = horizontal(wrapped, lineLimit)
+            return cls(start, *wrapped, end, type=type)
+
+        # Otherwise, each row is a Sequence inside a Stack.
+        # A top-level Sequence is just a row of items, so it can be broken up too.
+        breakable: List[DiagramItem] = []
+        for item in wrapped:
+            breakable.extend(item.items if isinstance(item, Sequence) else [item])
+        # The Stack needs 10px of space on each side and an arc on each side,
+        # and each of its rows needs another 10px on each side.
+        rowLimit = maxWidth - frame - 20 - AR * 2 - 20
+        rows = _breakRows(
+            breakable,
+            rowLimit,
+            (lambda row: horizontal(row, rowLimit)) if horizontalChoices else None,
+        )
+        if len(rows) == 1:
+            # Nothing could be broken up, so a Stack would only add width.
+            return cls(start, *rows[0], end, type=type)
+        stacked = [row[0] if len(row) == 1 else Sequence(*row) for row in rows]
+        return cls(start, Stack(*stacked), end, type=type)
+
+
+def _rowMetrics(items: Seq[DiagramItem]) -> Tuple[float, float, float, float]:
+    # The (width, up, height, down) that a Sequence of these items would have,
+    # without building the Sequence.
+    width: float = 0
+    up: float = 0
+    height: float = 0
+    down: float = 0
+    for item in items:
+        width += item.width + (20 if item.needsSpace else 0)
+        up = max(up, item.up - height)
+        height += item.height
+        down = max(down - item.height, item.down)
+    if items[0].needsSpace:
+        width -= 10
+    if items[-1].needsSpace:
+        width -= 10
+    return width, up, height, down
+
+
+def _rowExtent(metrics: Tuple[float, float, float, float]) -> float:
+    _, up, height, down = metrics
+    return up + height + down
+
+
+def _breakRows(
+    items: List[DiagramItem],
+    limit: float,
+    adjust: Opt[Callable[[List[DiagramItem]], List[DiagramItem]]] = None,
+) -> List[List[DiagramItem]]:
+    # Splits items into rows no wider than limit (as measured by _rowMetrics),
+    # minimizing, in order: the overflow of items too wide to fit on any row,
+    # the total height of the rows once stacked,
+    # and the squared slack of every row but the last.
+    # Standard dynamic programming over the break positions;
+    # best[j] holds the cheapest way to lay out items[:j].
+    n = len(items)
+    best: List[Opt[Tuple[Tuple[float, float, float], int, List[DiagramItem]]]] = [None] * (n + 1)
+    best[0] = ((0, 0, 0), 0, [])
+    for i in range(n):
+        prev = best[i]
+        if prev is None:
+            continue
+        (prevOverflow, prevHeight, prevRagged), _, _ = prev
+        width: float = 0
+        up: float = 0
+        height: float = 0
+        down: float = 0
+        for j in range(i + 1, n + 1):
+            item = items[j - 1]
+            width += item.width + (20 if item.needsSpace else 0)
+            up = max(up, item.up - height)
+            height += item.height
+            down = max(down - item.height, item.down)
+            rowWidth = width - (10 if items[i].needsSpace else 0) - (10 if item.needsSpace else 0)
+            if rowWidth > limit and j > i + 1:
+                # Rows only get wider from here.
+                break
+            row = items[i:j]
+            metrics = (rowWidth, up, height, down)
+            if adjust is not None and rowWidth <= limit:
+                row = adjust(row)
+                metrics = _rowMetrics(row)
+            rowWidth, rowUp, rowHeight, rowDown = metrics
+            # Rows after the first and before the last are separated by the Stack's snaking lines.
+            if i > 0:
+                rowUp = max(AR * 2, rowUp + VS)
+            if j < n:
+                rowDown = max(AR * 2, rowDown + VS)
+            overflow = max(0, rowWidth - limit)
+            ragged = (limit - rowWidth) ** 2 if j < n and overflow == 0 else 0
+            cost = (
+                prevOverflow + overflow,
+                prevHeight + rowUp + rowHeight + rowDown,
+                prevRagged + ragged,
+            )
+            current = best[j]
+            if current is None or cost < current[0]:
+                best[j] = (cost, i, row)
+    rows = []
+    j = n
+    while j > 0:
+        entry = best[j]
+        assert entry is not None
+        _, i, row = entry
+        rows.append(row)
+        j = i
+    rows.reverse()
+    return rows
 
 
 class Sequence(DiagramMultiContainer):
@@ -457,6 +1381,46 @@ class Sequence(DiagramMultiContainer):
             self.width -= 10
         addDebug(self)
 
+    @classmethod
+    def fromItems(cls, items: Iterable[Node]) -> Sequence:
+        # Same as Sequence(*items), but computes the dimensions
+        # with array operations rather than item-by-item,
+        # for very long generated sequences.
+        wrapped = [wrapString(item) for item in items]
+        columns = _bulkMetrics(wrapped)
+        if columns is None:
+            return cls(*wrapped)
+        self = cls.__new__(cls)
+        DiagramItem.__init__(self, "g")
+        self.items = wrapped
+        self.needsSpace = True
+        widths, ups, heights, downs, spaces = columns
+        # Widths are usually floats, so they're added up in order, as the constructor does.
+        self.width = sum(w + (20 if ns else 0) for w, ns in zip(widths, spaces))
+        numpy = _numpy()
+        if numpy is not None:
+            ups, heights, downs = (numpy.array(column, float) for column in (ups, heights, downs))
+            heightsBefore = numpy.cumsum(heights) - heights
+            heightsAfter = heights.sum() - heightsBefore - heights
+            self.up = max(0, int((ups - heightsBefore).max()))
+            self.height = int(heights.sum())
+            self.down = max(-self.height, int((downs - heightsAfter).max()))
+        else:
+            heightsBefore = [0, *itertools.accumulate(heights)]
+            total = heightsBefore.pop()
+            self.up = max(0, max(u - hb for u, hb in zip(ups, heightsBefore)))
+            self.height = total
+            self.down = max(
+                -total,
+                max(d - (total - hb - h) for d, h, hb in zip(downs, heights, heightsBefore)),
+            )
+        if self.items[0].needsSpace:
+            self.width -= 10
+        if self.items[-1].needsSpace:
+            self.width -= 10
+        addDebug(self)
+        return self
+
     def __repr__(self) -> str:
         items = ", ".join(repr(item) for item in self.items)
         return f"Sequence({items})"
@@ -470,7 +1434,7 @@ class Sequence(DiagramMultiContainer):
             if item.needsSpace and i > 0:
                 Path(x, y).h(10).addTo(self)
                 x += 10
-            item.format(x, y, item.width).addTo(self)
+            self.formatterFor(item)(x, y, item.width).addTo(self)
             x += item.width
             y += item.height
             if item.needsSpace and i < len(self.items) - 1:
@@ -478,11 +1442,25 @@ class Sequence(DiagramMultiContainer):
                 x += 10
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        placements = []
+        for i, item in enumerate(self.items):
+            if item.needsSpace and i > 0:
+                x += 10
+            placements.append((item, x, y, item.width))
+            x += item.width
+            y += item.height
+            if item.needsSpace and i < len(self.items) - 1:
+                x += 10
+        return placements
+
     def textDiagram(self) -> TextDiagram:
         (separator, ) = TextDiagram._getParts(["separator"])
         diagramTD = TextDiagram(0, 0, [""])
         for item in self.items:
-            itemTD = item.textDiagram()
+            itemTD = self.textDiagrammerFor(item)()
             if item.needsSpace:
                 itemTD = itemTD.expand(1, 1, 0, 0)
             diagramTD = diagramTD.appendRight(itemTD, separator)
@@ -511,6 +1489,41 @@ class Stack(DiagramMultiContainer):
                 self.height += max(AR * 2, item.down + VS)
         addDebug(self)
 
+    @classmethod
+    def fromItems(cls, items: Iterable[Node]) -> Stack:
+        # Same as Stack(*items), but computes the dimensions
+        # with array operations rather than item-by-item.
+        wrapped = [wrapString(item) for item in items]
+        columns = _bulkMetrics(wrapped)
+        if columns is None:
+            return cls(*wrapped)
+        self = cls.__new__(cls)
+        DiagramItem.__init__(self, "g")
+        self.items = wrapped
+        self.needsSpace = True
+        widths, ups, heights, downs, spaces = columns
+        self.width = max(w + (20 if ns else 0) for w, ns in zip(widths, spaces))
+        numpy = _numpy()
+        if numpy is not None:
+            ups, heights, downs = (numpy.array(column, float) for column in (ups, heights, downs))
+            self.height = int(
+                heights.sum()
+                + numpy.maximum(AR * 2, ups[1:] + VS).sum()
+                + numpy.maximum(AR * 2, downs[:-1] + VS).sum()
+            )
+        else:
+            self.height = (
+                sum(heights)
+                + sum(max(AR * 2, u + VS) for u in ups[1:])
+                + sum(max(AR * 2, d + VS) for d in downs[:-1])
+            )
+        if len(self.items) > 1:
+            self.width += AR * 2
+        self.up = self.items[0].up
+        self.down = self.items[-1].down
+        addDebug(self)
+        return self
+
     def __repr__(self) -> str:
         items = ", ".join(repr(item) for item in self.items)
         return f"Stack({items})"
@@ -527,7 +1540,7 @@ class Stack(DiagramMultiContainer):
         else:
             innerWidth = self.width
         for i, item in enumerate(self.items):
-            item.format(x, y, innerWidth).addTo(self)
+            self.formatterFor(item)(x, y, innerWidth).addTo(self)
             x += innerWidth
             y += item.height
             if i != len(self.items) - 1:
@@ -552,13 +1565,33 @@ class Stack(DiagramMultiContainer):
         Path(x, y).h(rightGap).addTo(self)
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        xInitial = x
+        if len(self.items) > 1:
+            x += AR
+            innerWidth = self.width - AR * 2
+        else:
+            innerWidth = self.width
+        placements = []
+        for i, item in enumerate(self.items):
+            placements.append((item, x, y, innerWidth))
+            y += item.height
+            if i != len(self.items) - 1:
+                y += max(item.down + VS, AR * 2) + max(
+                    self.items[i + 1].up + VS, AR * 2
+                )
+                x = xInitial + AR
+        return placements
+
     def textDiagram(self) -> TextDiagram:
         corner_bot_left, corner_bot_right, corner_top_left, corner_top_right, line, line_vertical = TextDiagram._getParts(["corner_bot_left", "corner_bot_right", "corner_top_left", "corner_top_right", "line", "line_vertical"])
 
         # Format all the child items, so we can know the maximum width.
         itemTDs = []
         for item in self.items:
-            itemTDs.append(item.textDiagram())
+            itemTDs.append(self.textDiagrammerFor(item)())
         maxWidth = max([itemTD.width for itemTD in itemTDs])
 
         leftLines = []
@@ -665,7 +1698,7 @@ class OptionalSequence(DiagramMultiContainer):
                 )
                 # Straight line
                 (Path(x, y).right(itemSpace + AR).addTo(self))
-                item.format(x + itemSpace + AR, y, item.width).addTo(self)
+                self.formatterFor(item)(x + itemSpace + AR, y, item.width).addTo(self)
                 x += itemWidth + AR
                 y += item.height
             elif i < last:
@@ -680,7 +1713,7 @@ class OptionalSequence(DiagramMultiContainer):
                 )
                 # Straight line
                 (Path(x, y).right(AR * 2).addTo(self))
-                item.format(x + AR * 2, y, item.width).addTo(self)
+                self.formatterFor(item)(x + AR * 2, y, item.width).addTo(self)
                 (
                     Path(x + item.width + AR * 2, y + item.height)
                     .right(itemSpace + AR)
@@ -703,7 +1736,7 @@ class OptionalSequence(DiagramMultiContainer):
             else:
                 # Straight line
                 (Path(x, y).right(AR * 2).addTo(self))
-                item.format(x + AR * 2, y, item.width).addTo(self)
+                self.formatterFor(item)(x + AR * 2, y, item.width).addTo(self)
                 (
                     Path(x + AR * 2 + item.width, y + item.height)
                     .right(itemSpace + AR)
@@ -723,13 +1756,33 @@ class OptionalSequence(DiagramMultiContainer):
                 )
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        last = len(self.items) - 1
+        placements = []
+        for i, item in enumerate(self.items):
+            itemSpace = 10 if item.needsSpace else 0
+            itemWidth = item.width + itemSpace
+            if i == 0:
+                placements.append((item, x + itemSpace + AR, y, item.width))
+                x += itemWidth + AR
+                y += item.height
+            elif i < last:
+                placements.append((item, x + AR * 2, y, item.width))
+                x += AR * 2 + max(itemWidth, AR) + AR
+                y += item.height
+            else:
+                placements.append((item, x + AR * 2, y, item.width))
+        return placements
+
     def textDiagram(self) -> TextDiagram:
         line, line_vertical, roundcorner_bot_left, roundcorner_bot_right, roundcorner_top_left, roundcorner_top_right = TextDiagram._getParts(["line", "line_vertical", "roundcorner_bot_left", "roundcorner_bot_right", "roundcorner_top_left", "roundcorner_top_right"])
 
         # Format all the child items, so we can know the maximum entry.
         itemTDs = []
         for item in self.items:
-            itemTDs.append(item.textDiagram())
+            itemTDs.append(self.textDiagrammerFor(item)())
         # diagramEntry: distance from top to lowest entry, aka distance from top to diagram entry, aka final diagram entry and exit.
         diagramEntry = max([itemTD.entry for itemTD in itemTDs])
         # SOILHeight: distance from top to lowest entry before rightmost item, aka distance from skip-over-items line to rightmost entry, aka SOIL height.
@@ -859,7 +1912,7 @@ class AlternatingSequence(DiagramMultiContainer):
         firstIn = self.up - first.up
         firstOut = self.up - first.up - first.height
         Path(x, y).arc("se").up(firstIn - 2 * arc).arc("wn").addTo(self)
-        first.format(x + 2 * arc, y - firstIn, self.width - 4 * arc).addTo(self)
+        self.formatterFor(first)(x + 2 * arc, y - firstIn, self.width - 4 * arc).addTo(self)
         Path(x + self.width - 2 * arc, y - firstOut).arc("ne").down(
             firstOut - 2 * arc
         ).arc("ws").addTo(self)
@@ -868,7 +1921,7 @@ class AlternatingSequence(DiagramMultiContainer):
         secondIn = self.down - second.down - second.height
         secondOut = self.down - second.down
         Path(x, y).arc("ne").down(secondIn - 2 * arc).arc("ws").addTo(self)
-        second.format(x + 2 * arc, y + secondIn, self.width - 4 * arc).addTo(self)
+        self.formatterFor(second)(x + 2 * arc, y + secondIn, self.width - 4 * arc).addTo(self)
         Path(x + self.width - 2 * arc, y + secondOut).arc("se").up(
             secondOut - 2 * arc
         ).arc("wn").addTo(self)
@@ -904,11 +1957,22 @@ class AlternatingSequence(DiagramMultiContainer):
 
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        x += determineGaps(width, self.width)[0]
+        first = self.items[0]
+        second = self.items[1]
+        firstIn = self.up - first.up
+        secondIn = self.down - second.down - second.height
+        return [
+            (first, x + 2 * AR, y - firstIn, self.width - 4 * AR),
+            (second, x + 2 * AR, y + secondIn, self.width - 4 * AR),
+        ]
+
     def textDiagram(self) -> TextDiagram:
         cross_diag, corner_bot_left, corner_bot_right, corner_top_left, corner_top_right, line, line_vertical, tee_left, tee_right = TextDiagram._getParts(["cross_diag", "roundcorner_bot_left", "roundcorner_bot_right", "roundcorner_top_left", "roundcorner_top_right", "line", "line_vertical", "tee_left", "tee_right"])
 
-        firstTD = self.items[0].textDiagram()
-        secondTD = self.items[1].textDiagram()
+        firstTD = self.textDiagrammerFor(self.items[0])()
+        secondTD = self.textDiagrammerFor(self.items[1])()
         maxWidth = TextDiagram._maxWidth(firstTD, secondTD)
         leftWidth, rightWidth = TextDiagram._gaps(maxWidth, 0)
         leftLines = []
@@ -960,7 +2024,7 @@ class Choice(DiagramMultiContainer):
         # and the following item.
         # The calcs are non-trivial and need to be done both here
         # and in .format(), so no reason to do it twice.
-        self.separators: list[int] = [VS] * (len(items) - 1)
+        self.separators: list[float] = [VS] * (len(items) - 1)
 
         # If the entry or exit lines would be too close together
         # to accommodate the arcs,
@@ -1007,6 +2071,49 @@ class Choice(DiagramMultiContainer):
         self.down += self.items[-1].down
         addDebug(self)
 
+    @classmethod
+    def fromItems(cls, default: int, items: Iterable[Node]) -> Choice:
+        # Same as Choice(default, *items), but computes the separators
+        # and dimensions with NumPy array operations rather than item-by-item,
+        # for generated choices with thousands of alternatives.
+        # (Without NumPy, the constructor's own loop is as fast as plain Python gets.)
+        wrapped = [wrapString(item) for item in items]
+        numpy = _numpy()
+        columns = None if numpy is None else _bulkMetrics(wrapped)
+        if columns is None:
+            return cls(default, *wrapped)
+        self = cls.__new__(cls)
+        DiagramItem.__init__(self, "g")
+        self.items = wrapped
+        assert default < len(self.items)
+        self.default = default
+        widths, ups, heights, downs, _ = columns
+        self.width = AR * 4 + max(widths)
+        self.height = self.items[default].height
+        ups, heights, downs = (numpy.array(column, float) for column in (ups, heights, downs))
+
+        # Separator k sits between items k and k+1.
+        # The entry/exit deltas are the same whichever side of the default it's on;
+        # only the arcs needing room differ, being doubled next to the default.
+        base = ups[1:] + VS + downs[:-1]
+        arcs = numpy.full(len(base), float(AR))
+        arcs[max(default - 1, 0) : default + 1] = AR * 2
+        separators = VS + numpy.maximum(
+            0, arcs - base - numpy.minimum(heights[:-1], heights[1:])
+        )
+        spans = ups[1:] + separators + downs[:-1]
+        self.up = int((spans[:default] + heights[:default]).sum() + ups[0])
+        self.down = int((spans[default:] + heights[default + 1 :]).sum() + downs[-1])
+        self.separators = separators.astype(numpy.int64).tolist()
+        addDebug(self)
+        return self
+
+    def _fingerprintSource(self) -> str:
+        return f"default={self.default};" + DiagramMultiContainer._fingerprintSource(self)
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": "Choice", "default": self.default, "items": subItems}
+
     def __repr__(self) -> str:
         items = ", ".join(repr(item) for item in self.items)
         return f"Choice({self.default}, {items})"
@@ -1023,13 +2130,13 @@ class Choice(DiagramMultiContainer):
         default = self.items[self.default]
 
         # Do the elements that curve above
-        distanceFromY = 0
+        distanceFromY: float = 0
         for i in range(self.default - 1, -1, -1):
             item = self.items[i]
             lowerItem = self.items[i+1]
             distanceFromY += lowerItem.up + self.separators[i] + item.down + item.height
             Path(x, y).arc("se").up(distanceFromY - AR * 2).arc("wn").addTo(self)
-            item.format(x + AR * 2, y - distanceFromY, innerWidth).addTo(self)
+            self.formatterFor(item)(x + AR * 2, y - distanceFromY, innerWidth).addTo(self)
             Path(x + AR * 2 + innerWidth, y - distanceFromY + item.height).arc(
                 "ne"
             ).down(distanceFromY - item.height + default.height - AR * 2).arc(
@@ -1040,7 +2147,7 @@ class Choice(DiagramMultiContainer):
 
         # Do the straight-line path.
         Path(x, y).right(AR * 2).addTo(self)
-        self.items[self.default].format(x + AR * 2, y, innerWidth).addTo(self)
+        self.formatterFor(self.items[self.default])(x + AR * 2, y, innerWidth).addTo(self)
         Path(x + AR * 2 + innerWidth, y + self.height).right(AR * 2).addTo(self)
 
         # Do the elements that curve below
@@ -1050,19 +2157,39 @@ class Choice(DiagramMultiContainer):
             upperItem = self.items[i-1]
             distanceFromY += upperItem.height + upperItem.down + self.separators[i-1] + item.up
             Path(x, y).arc("ne").down(distanceFromY - AR * 2).arc("ws").addTo(self)
-            item.format(x + AR * 2, y + distanceFromY, innerWidth).addTo(self)
+            self.formatterFor(item)(x + AR * 2, y + distanceFromY, innerWidth).addTo(self)
             Path(x + AR * 2 + innerWidth, y + distanceFromY + item.height).arc("se").up(
                 distanceFromY - AR * 2 + item.height - default.height
             ).arc("wn").addTo(self)
 
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        innerWidth = self.width - AR * 4
+        placements = []
+        distanceFromY: float = 0
+        for i in range(self.default - 1, -1, -1):
+            item = self.items[i]
+            lowerItem = self.items[i+1]
+            distanceFromY += lowerItem.up + self.separators[i] + item.down + item.height
+            placements.append((item, x + AR * 2, y - distanceFromY, innerWidth))
+        placements.append((self.items[self.default], x + AR * 2, y, innerWidth))
+        distanceFromY = 0
+        for i in range(self.default+1, len(self.items)):
+            item = self.items[i]
+            upperItem = self.items[i-1]
+            distanceFromY += upperItem.height + upperItem.down + self.separators[i-1] + item.up
+            placements.append((item, x + AR * 2, y + distanceFromY, innerWidth))
+        return placements
+
     def textDiagram(self) -> TextDiagram:
         cross, line, line_vertical, roundcorner_bot_left, roundcorner_bot_right, roundcorner_top_left, roundcorner_top_right = TextDiagram._getParts(["cross", "line", "line_vertical", "roundcorner_bot_left", "roundcorner_bot_right", "roundcorner_top_left", "roundcorner_top_right"])
         # Format all the child items, so we can know the maximum width.
         itemTDs = []
         for item in self.items:
-            itemTDs.append(item.textDiagram().expand(1, 1, 0, 0))
+            itemTDs.append(self.textDiagrammerFor(item)().expand(1, 1, 0, 0))
         max_item_width = max([i.width for i in itemTDs])
         diagramTD = TextDiagram(0, 0, [])
         # Format the choice collection.
@@ -1156,6 +2283,12 @@ class MultipleChoice(DiagramMultiContainer):
         self.down -= self.items[default].height  # already counted in self.height
         addDebug(self)
 
+    def _fingerprintSource(self) -> str:
+        return f"default={self.default};type={self.type};" + DiagramMultiContainer._fingerprintSource(self)
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": "MultipleChoice", "default": self.default, "type": self.type, "items": subItems}
+
     def __repr__(self) -> str:
         items = ", ".join(repr(item) for item in self.items)
         return f"MultipleChoice({repr(self.default)}, {repr(self.type)}, {items})"
@@ -1178,7 +2311,7 @@ class MultipleChoice(DiagramMultiContainer):
             )
         for i, ni, item in doubleenumerate(above):
             (Path(x + 30, y).up(distanceFromY - AR).arc("wn").addTo(self))
-            item.format(x + 30 + AR, y - distanceFromY, self.innerWidth).addTo(self)
+            self.formatterFor(item)(x + 30 + AR, y - distanceFromY, self.innerWidth).addTo(self)
             (
                 Path(x + 30 + AR + self.innerWidth, y - distanceFromY + item.height)
                 .arc("ne")
@@ -1192,7 +2325,7 @@ class MultipleChoice(DiagramMultiContainer):
 
         # Do the straight-line path.
         Path(x + 30, y).right(AR).addTo(self)
-        self.items[self.default].format(x + 30 + AR, y, self.innerWidth).addTo(self)
+        self.formatterFor(self.items[self.default])(x + 30 + AR, y, self.innerWidth).addTo(self)
         Path(x + 30 + AR + self.innerWidth, y + self.height).right(AR).addTo(self)
 
         # Do the elements that curve below
@@ -1203,7 +2336,7 @@ class MultipleChoice(DiagramMultiContainer):
             )
         for i, item in enumerate(below):
             (Path(x + 30, y).down(distanceFromY - AR).arc("ws").addTo(self))
-            item.format(x + 30 + AR, y + distanceFromY, self.innerWidth).addTo(self)
+            self.formatterFor(item)(x + 30 + AR, y + distanceFromY, self.innerWidth).addTo(self)
             (
                 Path(x + 30 + AR + self.innerWidth, y + distanceFromY + item.height)
                 .arc("se")
@@ -1254,6 +2387,39 @@ class MultipleChoice(DiagramMultiContainer):
         ).addTo(text)
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        default = self.items[self.default]
+        placements = []
+        above = self.items[: self.default][::-1]
+        if above:
+            distanceFromY = max(
+                10 + AR, default.up + VS + above[0].down + above[0].height
+            )
+        for i, ni, item in doubleenumerate(above):
+            placements.append((item, x + 30 + AR, y - distanceFromY, self.innerWidth))
+            if ni < -1:
+                distanceFromY += max(
+                    AR, item.up + VS + above[i + 1].down + above[i + 1].height
+                )
+        placements.append((default, x + 30 + AR, y, self.innerWidth))
+        below = self.items[self.default + 1 :]
+        if below:
+            distanceFromY = max(
+                10 + AR, default.height + default.down + VS + below[0].up
+            )
+        for i, item in enumerate(below):
+            placements.append((item, x + 30 + AR, y + distanceFromY, self.innerWidth))
+            distanceFromY += max(
+                AR,
+                item.height
+                + item.down
+                + VS
+                + (below[i + 1].up if i + 1 < len(below) else 0),
+            )
+        return placements
+
     def textDiagram(self) -> TextDiagram:
         (multi_repeat,) = TextDiagram._getParts(["multi_repeat"])
         anyAll = TextDiagram.rect("1+" if self.type == "any" else "all")
@@ -1368,7 +2534,7 @@ class HorizontalChoice(DiagramMultiContainer):
 
             # item
             itemWidth = item.width + (20 if item.needsSpace else 0)
-            item.format(x, y, itemWidth).addTo(self)
+            self.formatterFor(item)(x, y, itemWidth).addTo(self)
             x += itemWidth
 
             # output track
@@ -1405,6 +2571,17 @@ class HorizontalChoice(DiagramMultiContainer):
                 )
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        placements = []
+        for i, item in enumerate(self.items):
+            x += AR if i == 0 else AR * 2
+            itemWidth = item.width + (20 if item.needsSpace else 0)
+            placements.append((item, x, y, itemWidth))
+            x += itemWidth
+        return placements
+
     def __repr__(self) -> str:
         items = ", ".join(repr(item) for item in self.items)
         return f"HorizontalChoice({items})"
@@ -1415,7 +2592,7 @@ class HorizontalChoice(DiagramMultiContainer):
         # Format all the child items, so we can know the maximum entry, exit, and height.
         itemTDs = []
         for item in self.items:
-            itemTDs.append(item.textDiagram())
+            itemTDs.append(self.textDiagrammerFor(item)())
         # diagramEntry: distance from top to lowest entry, aka distance from top to diagram entry, aka final diagram entry and exit.
         diagramEntry = max([itemTD.entry for itemTD in itemTDs])
         # SOILToBaseline: distance from top to lowest entry before rightmost item, aka distance from skip-over-items line to rightmost entry, aka SOIL height.
@@ -1524,7 +2701,7 @@ class OneOrMore(DiagramItem):
 
         # Draw item
         Path(x, y).right(AR).addTo(self)
-        self.item.format(x + AR, y, self.width - AR * 2).addTo(self)
+        self.formatterFor(self.item)(x + AR, y, self.width - AR * 2).addTo(self)
         Path(x + self.width - AR, y + self.height).right(AR).addTo(self)
 
         # Draw repeat arc
@@ -1532,18 +2709,29 @@ class OneOrMore(DiagramItem):
             AR * 2, self.item.height + self.item.down + VS + self.rep.up
         )
         Path(x + AR, y).arc("nw").down(distanceFromY - AR * 2).arc("ws").addTo(self)
-        self.rep.format(x + AR, y + distanceFromY, self.width - AR * 2).addTo(self)
+        self.formatterFor(self.rep)(x + AR, y + distanceFromY, self.width - AR * 2).addTo(self)
         Path(x + self.width - AR, y + distanceFromY + self.rep.height).arc("se").up(
             distanceFromY - AR * 2 + self.rep.height - self.item.height
         ).arc("en").addTo(self)
 
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        distanceFromY = max(
+            AR * 2, self.item.height + self.item.down + VS + self.rep.up
+        )
+        return [
+            (self.item, x + AR, y, self.width - AR * 2),
+            (self.rep, x + AR, y + distanceFromY, self.width - AR * 2),
+        ]
+
     def textDiagram(self) -> TextDiagram:
         line, repeat_top_left, repeat_left, repeat_bot_left, repeat_top_right, repeat_right, repeat_bot_right = TextDiagram._getParts(["line", "repeat_top_left", "repeat_left", "repeat_bot_left", "repeat_top_right", "repeat_right", "repeat_bot_right"])
         # Format the item and then format the repeat append it to tbe bottom, after a spacer.
-        itemTD = self.item.textDiagram()
-        repeatTD = self.rep.textDiagram()
+        itemTD = self.textDiagrammerFor(self.item)()
+        repeatTD = self.textDiagrammerFor(self.rep)()
         fIRWidth = TextDiagram._maxWidth(itemTD, repeatTD)
         repeatTD = repeatTD.expand(0, fIRWidth - repeatTD.width, 0, 0)
         itemTD = itemTD.expand(0, fIRWidth - itemTD.width, 0, 0)
@@ -1564,10 +2752,14 @@ class OneOrMore(DiagramItem):
         diagramTD = leftTD.appendRight(rightTD, "")
         return diagramTD
 
-    def walk(self, cb: WalkerF) -> None:
-        cb(self)
-        self.item.walk(cb)
-        self.rep.walk(cb)
+    def _subItems(self) -> List[DiagramItem]:
+        return [self.item, self.rep]
+
+    def _fingerprintSource(self) -> str:
+        return f"OneOrMore({self.item.fingerprint()},{self.rep.fingerprint()})"
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": "OneOrMore", "item": subItems[0], "repeat": subItems[1]}
 
     def __repr__(self) -> str:
         return f"OneOrMore({repr(self.item)}, repeat={repr(self.rep)})"
@@ -1623,9 +2815,9 @@ class Group(DiagramItem):
             },
         ).addTo(self)
 
-        self.item.format(x, y, self.width).addTo(self)
+        self.formatterFor(self.item)(x, y, self.width).addTo(self)
         if self.label:
-            self.label.format(
+            self.formatterFor(self.label)(
                 x,
                 y - (self.boxUp + self.label.down + self.label.height),
                 self.label.width,
@@ -1633,18 +2825,40 @@ class Group(DiagramItem):
 
         return self
 
+    def _layoutChildren(self, x: float, y: float, width: float) -> List[PlacementT]:
+        leftGap, _ = determineGaps(width, self.width)
+        x += leftGap
+        placements = [(self.item, x, y, self.width)]
+        if self.label:
+            placements.append(
+                (
+                    self.label,
+                    x,
+                    y - (self.boxUp + self.label.down + self.label.height),
+                    self.label.width,
+                )
+            )
+        return placements
+
     def textDiagram(self) -> TextDiagram:
-        diagramTD = TextDiagram.roundrect(self.item.textDiagram(), dashed=True)
+        diagramTD = TextDiagram.roundrect(self.textDiagrammerFor(self.item)(), dashed=True)
         if self.label:
-            labelTD = self.label.textDiagram()
+            labelTD = self.textDiagrammerFor(self.label)()
             diagramTD = labelTD.appendBelow(diagramTD, [], moveEntry=True, moveExit=True).expand(0, 0, 1, 0)
         return diagramTD
 
-    def walk(self, cb: WalkerF) -> None:
-        cb(self)
-        self.item.walk(cb)
+    def _subItems(self) -> List[DiagramItem]:
+        return [self.item, self.label] if self.label else [self.item]
+
+    def _fingerprintSource(self) -> str:
+        label = self.label.fingerprint() if self.label else ""
+        return f"Group({self.item.fingerprint()},{label})"
+
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        data = {"kind": "Group", "item": subItems[0]}
         if self.label:
-            self.label.walk(cb)
+            data["label"] = subItems[1]
+        return data
 
     def __repr__(self) -> str:
         return f"Group({repr(self.item)}, label={repr(self.label)})"
@@ -1690,6 +2904,12 @@ class Start(DiagramItem):
         startTD = TextDiagram(0, 0, [start])
         return labelTD.appendBelow(startTD, [], moveEntry=True, moveExit=True)
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        data = {"kind": "Start", "type": self.type}
+        if self.label:
+            data["label"] = self.label
+        return data
+
     def __repr__(self) -> str:
         return f"Start(type={repr(self.type)}, label={repr(self.label)})"
 
@@ -1718,6 +2938,9 @@ class End(DiagramItem):
             end = line + tee_left
         return TextDiagram(0, 0, [end])
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": "End", "type": self.type}
+
     def __repr__(self) -> str:
         return f"End(type={repr(self.type)})"
 
@@ -1737,6 +2960,9 @@ class Terminal(DiagramItem):
         self.needsSpace = True
         addDebug(self)
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return textItemDict("Terminal", self)
+
     def __repr__(self) -> str:
         return f"Terminal({repr(self.text)}, href={repr(self.href)}, title={repr(self.title)}, cls={repr(self.cls)})"
 
@@ -1790,6 +3016,9 @@ class NonTerminal(DiagramItem):
         self.needsSpace = True
         addDebug(self)
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return textItemDict("NonTerminal", self)
+
     def __repr__(self) -> str:
         return f"NonTerminal({repr(self.text)}, href={repr(self.href)}, title={repr(self.title)}, cls={repr(self.cls)})"
 
@@ -1841,6 +3070,9 @@ class Comment(DiagramItem):
         self.needsSpace = True
         addDebug(self)
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return textItemDict("Comment", self)
+
     def __repr__(self) -> str:
         return f"Comment({repr(self.text)}, href={repr(self.href)}, title={repr(self.title)}, cls={repr(self.cls)})"
 
@@ -1886,6 +3118,9 @@ class Skip(DiagramItem):
         (line,) = TextDiagram._getParts(["line"])
         return TextDiagram(0, 0, [line])
 
+    def _toDict(self, subItems: List[Any]) -> Dict[str, Any]:
+        return {"kind": "Skip"}
+
     def __repr__(self) -> str:
         return "Skip()"
 
@@ -1910,6 +3145,9 @@ class TextDiagram:
         assert exit <= len(lines), f"Exit is not within diagram vertically:{nl}{self._dump(False)}"
         for i in range(0, len(lines)):
             assert len(lines[0]) == len(lines[i]), f"Diagram data is not rectangular:{nl}{self._dump(False)}"
+        usage = _activeBudget.get()
+        if usage is not None:
+            usage.textLaidOut(self)
 
     def alter(self, entry: int = None, exit: int = None, lines: List[str] = None) -> TextDiagram:
         """
@@ -2281,8 +3519,1773 @@ class TextDiagram:
 # Default to Unicode box characters, they're much prettier than raw ASCII.
 TextDiagram.setFormatting(TextDiagram.PARTS_UNICODE)
 
+
+def textItemDict(kind: str, item: Union[Terminal, NonTerminal, Comment]) -> Dict[str, Any]:
+    data: Dict[str, Any] = {"kind": kind, "text": item.text}
+    if item.href is not None:
+        data["href"] = item.href
+    if item.title is not None:
+        data["title"] = item.title
+    if item.cls:
+        data["cls"] = item.cls
+    return data
+
+
+def fromJson(source: Union[str, bytes], maxDepth: int = 500, maxNodes: int = 100_000) -> DiagramItem:
+    """
+    Rebuild a Diagram (or any other item) from the JSON that .toJson() produces.
+
+    See fromDict() for the limits.
+    """
+    try:
+        data = json.loads(source)
+    except RecursionError as err:
+        raise ValueError("Diagram JSON is nested too deeply to parse.") from err
+    except ValueError as err:
+        raise ValueError(f"Invalid diagram JSON: {err}") from err
+    return fromDict(data, maxDepth=maxDepth, maxNodes=maxNodes)
+
+
+def fromDict(data: Any, maxDepth: int = 500, maxNodes: int = 100_000) -> DiagramItem:
+    """
+    Rebuild a Diagram (or any other item) from the dict that .toDict() produces.
+
+    The tree is built bottom-up with an explicit stack rather than recursively,
+    and untrusted input is checked as it's read:
+    anything malformed, nested more than maxDepth items deep,
+    or containing more than maxNodes items raises a ValueError
+    before the rest of the tree is built.
+    """
+    # Each frame is [data, path, child datas, index of the next child to build, built children].
+    root: List[Any] = [data, "$", _dictChildren(data, "$"), 0, []]
+    stack = [root]
+    nodes = 1
+    while True:
+        frame = stack[-1]
+        itemData, path, childDatas, index, built = frame
+        if index < len(childDatas):
+            frame[3] += 1
+            childData, childPath = childDatas[index]
+            nodes += 1
+            if nodes > maxNodes:
+                raise ValueError(f"Diagram has more than {maxNodes} items (at {childPath}).")
+            if len(stack) >= maxDepth:
+                raise ValueError(f"Diagram is nested more than {maxDepth} items deep.")
+            stack.append([childData, childPath, _dictChildren(childData, childPath), 0, []])
+            continue
+        item = _itemFromDict(itemData, path, built)
+        stack.pop()
+        if not stack:
+            return item
+        stack[-1][4].append(item)
+
+
+def _dictChildren(data: Any, path: str) -> List[Tuple[Any, str]]:
+    # The (data, path) of each child item in an item's dict, in _subItems() order.
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a diagram item object at {path}, but got {type(data).__name__}.")
+    kind = data.get("kind")
+    if kind not in DICT_BUILDERS:
+        raise ValueError(f"Unknown diagram item kind {kind!r} at {path}.")
+    if "items" in DICT_BUILDERS[kind][1]:
+        items = data.get("items")
+        if not isinstance(items, list) or not items:
+            raise ValueError(f"Expected a non-empty 'items' list at {path}.")
+        return [(child, f"{path}.items[{i}]") for i, child in enumerate(items)]
+    children = []
+    for key in ("item", "repeat", "label"):
+        if key in DICT_BUILDERS[kind][1] and (key != "label" or "label" in data):
+            if key not in data:
+                raise ValueError(f"Missing '{key}' at {path}.")
+            children.append((data[key], f"{path}.{key}"))
+    return children
+
+
+def _unpickleItem(data: Dict[str, Any], padding: Opt[Tuple[float, float, float, float]] = None) -> DiagramItem:
+    # The pickled dict is trusted, and its children are already items.
+    children = [child for child, _ in _dictChildren(data, "$")]
+    item = DICT_BUILDERS[data["kind"]][0](data, "$", children)
+    if isinstance(item, Diagram) and padding is not None:
+        item.format(*padding)
+    return item
+
+
+def _dictField(data: Dict[str, Any], path: str, key: str, types: Any, default: Any = None) -> Any:
+    value = data.get(key, default)
+    if not isinstance(value, types) or isinstance(value, bool) and bool not in types:
+        raise ValueError(f"Invalid '{key}' at {path}: {value!r}.")
+    return value
+
+
+def _itemFromDict(data: Dict[str, Any], path: str, children: List[DiagramItem]) -> DiagramItem:
+    kind = data["kind"]
+    build, _ = DICT_BUILDERS[kind]
+    if kind in ("Choice", "MultipleChoice"):
+        default = _dictField(data, path, "default", (int,), 0)
+        if not 0 <= default < len(children):
+            raise ValueError(f"Invalid 'default' at {path}: {default} isn't the index of one of its {len(children)} items.")
+    if kind == "MultipleChoice" and _dictField(data, path, "type", (str,), "any") not in ("any", "all"):
+        raise ValueError(f"Invalid 'type' at {path}: expected 'any' or 'all'.")
+    if kind == "AlternatingSequence" and len(children) != 2:
+        raise ValueError(f"An AlternatingSequence needs exactly two items, but got {len(children)} at {path}.")
+    try:
+        return build(data, path, children)
+    except ValueError:
+        raise
+    except Exception as err:  # pylint: disable=broad-except
+        # Anything the checks above missed, like MultipleChoice's asserted type.
+        raise ValueError(f"Invalid {kind} at {path}: {type(err).__name__}: {err}") from err
+
+
+def _textItemFromDict(cls: Any) -> Callable[[Dict[str, Any], str, List[DiagramItem]], DiagramItem]:
+    def build(data: Dict[str, Any], path: str, children: List[DiagramItem]) -> DiagramItem:
+        return cls(
+            _dictField(data, path, "text", (str,)),
+            href=_dictField(data, path, "href", (str, type(None))),
+            title=_dictField(data, path, "title", (str, type(None))),
+            cls=_dictField(data, path, "cls", (str,), ""),
+        )
+
+    return build
+
+
+# For each kind of item: how to build it from its dict and built children,
+# and which keys hold its children.
+DICT_BUILDERS: Dict[str, Tuple[Callable[[Dict[str, Any], str, List[DiagramItem]], DiagramItem], Tuple[str, ...]]] = {
+    "Diagram": (
+        lambda data, path, children: Diagram(
+            *children, type=_dictField(data, path, "type", (str,), "simple")
+        ),
+        ("items",),
+    ),
+    "Sequence": (lambda data, path, children: Sequence(*children), ("items",)),
+    "Stack": (lambda data, path, children: Stack(*children), ("items",)),
+    "OptionalSequence": (lambda data, path, children: OptionalSequence(*children), ("items",)),
+    "AlternatingSequence": (
+        lambda data, path, children: AlternatingSequence(*children),
+        ("items",),
+    ),
+    "Choice": (
+        lambda data, path, children: Choice(
+            _dictField(data, path, "default", (int,), 0), *children
+        ),
+        ("items",),
+    ),
+    "MultipleChoice": (
+        lambda data, path, children: MultipleChoice(
+            _dictField(data, path, "default", (int,), 0),
+            _dictField(data, path, "type", (str,), "any"),
+            *children,
+        ),
+        ("items",),
+    ),
+    "HorizontalChoice": (lambda data, path, children: HorizontalChoice(*children), ("items",)),
+    "OneOrMore": (lambda data, path, children: OneOrMore(*children), ("item", "repeat")),
+    "Group": (lambda data, path, children: Group(*children), ("item", "label")),
+    "Start": (
+        lambda data, path, children: Start(
+            _dictField(data, path, "type", (str,), "simple"),
+            _dictField(data, path, "label", (str, type(None))),
+        ),
+        (),
+    ),
+    "End": (lambda data, path, children: End(_dictField(data, path, "type", (str,), "simple")), ()),
+    "Terminal": (_textItemFromDict(Terminal), ()),
+    "NonTerminal": (_textItemFromDict(NonTerminal), ()),
+    "Comment": (_textItemFromDict(Comment), ()),
+    "Skip": (lambda data, path, children: Skip(), ()),
+}
+# The classes that DICT_BUILDERS rebuild items as.
+DICT_CLASSES = {globals()[kind] for kind in DICT_BUILDERS}
+
+
+# The constructor expressions that __repr__ and generator.html use, like
+#   Diagram(Sequence('a', Choice(0, 'b', NonTerminal('c', href='#c'))))
+REPR_TOKENS = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<string>'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")
+    | (?P<number>-?\d+)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<punct>[(),=])
+    """,
+    re.VERBOSE,
+)
+REPR_NAMES = {"None": None, "True": True, "False": False, "null": None, "true": True, "false": False}
+
+
+def fromRepr(source: str, maxDepth: int = 500, maxNodes: int = 100_000) -> DiagramItem:
+    """
+    Build a Diagram (or any other item) from constructor syntax like `Diagram(Sequence('a', 'b'))`,
+    as produced by repr() or written for generator.html.
+
+    Nothing is evaluated: only the item constructors listed in REPR_CONSTRUCTORS,
+    with their own keyword arguments, and string/integer/True/False/None literals
+    (or JS's true/false/null) are accepted, and anything else raises a ValueError saying where.
+    Like fromDict(), the parser uses an explicit stack,
+    and rejects input nested more than maxDepth calls deep or with more than maxNodes items (calls, or bare strings that become Terminals).
+    """
+    tokens: List[Tuple[str, str, int]] = []
+    pos = 0
+    while pos < len(source):
+        match = REPR_TOKENS.match(source, pos)
+        if match is None:
+            raise ValueError(f"Unexpected character {source[pos]!r}{_sourceLocation(source, pos)}.")
+        kind = match.lastgroup
+        assert kind is not None
+        if kind != "space":
+            tokens.append((kind, match.group(), pos))
+        pos = match.end()
+    tokens.append(("end", "", len(source)))
+
+    def fail(i: int, message: str) -> ValueError:
+        kind, text, at = tokens[i]
+        found = repr(text) if kind != "end" else "end of input"
+        return ValueError(f"{message}, but found {found}{_sourceLocation(source, at)}.")
+
+    # Each frame is [constructor name, positional args, keyword args, keyword being read, offset].
+    stack: List[List[Any]] = []
+    nodes = 0
+    i = 0
+    while True:
+        # Read a value, possibly as a keyword argument of the innermost call.
+        kind, text, at = tokens[i]
+        if stack and kind == "name" and tokens[i + 1][1] == "=":
+            if text in stack[-1][2]:
+                raise ValueError(f"Argument {text!r} given twice{_sourceLocation(source, at)}.")
+            stack[-1][3] = text
+            i += 2
+            kind, text, at = tokens[i]
+        elif stack and stack[-1][2]:
+            raise fail(i, "Expected a keyword argument after another keyword argument")
+        if kind == "name" and tokens[i + 1][1] == "(":
+            if text not in REPR_CONSTRUCTORS:
+                raise ValueError(f"Unknown constructor {text!r}{_sourceLocation(source, at)}.")
+            nodes += 1
+            if nodes > maxNodes:
+                raise ValueError(f"Input has more than {maxNodes} items{_sourceLocation(source, at)}.")
+            if len(stack) >= maxDepth:
+                raise ValueError(f"Input is nested more than {maxDepth} items deep.")
+            stack.append([text, [], {}, None, at])
+            i += 2
+            if tokens[i][1] != ")":
+                continue
+            value: Any = _reprCall(stack.pop(), source)
+        elif kind == "string":
+            try:
+                if "\\" not in text:
+                    value = text[1:-1]
+                else:
+                    import ast  # pylint: disable=import-outside-toplevel
+
+                    value = ast.literal_eval(text)
+            except (SyntaxError, ValueError) as err:
+                # Like a bad \x or \N{...} escape.
+                raise ValueError(f"Invalid string {text}{_sourceLocation(source, at)}: {err.msg if isinstance(err, SyntaxError) else err}.") from None
+            if stack and stack[-1][3] is None and stack[-1][0] not in ("Terminal", "NonTerminal", "Comment", "Start"):
+                # Bare strings in containers become Terminals, so they count as items too.
+                nodes += 1
+                if nodes > maxNodes:
+                    raise ValueError(f"Input has more than {maxNodes} items{_sourceLocation(source, at)}.")
+        elif kind == "number":
+            value = int(text)
+        elif kind == "name" and text in REPR_NAMES:
+            value = REPR_NAMES[text]
+        elif kind == "name":
+            raise ValueError(f"Unknown name {text!r}{_sourceLocation(source, at)}.")
+        else:
+            raise fail(i, "Expected a constructor call or a literal")
+        i += 1
+
+        # Hand the value to the enclosing call, closing as many calls as end here.
+        while True:
+            if not stack:
+                if tokens[i][0] != "end":
+                    raise fail(i, "Expected the end of input")
+                if not isinstance(value, DiagramItem):
+                    raise ValueError("Expected a diagram item, like Diagram(...).")
+                return value
+            frame = stack[-1]
+            if frame[3] is None:
+                frame[1].append(value)
+            else:
+                frame[2][frame[3]] = value
+                frame[3] = None
+            if tokens[i][1] == ",":
+                i += 1
+                if tokens[i][1] != ")":
+                    break
+            elif tokens[i][1] != ")":
+                raise fail(i, "Expected ',' or ')'")
+            i += 1
+            value = _reprCall(stack.pop(), source)
+
+
+def _reprCall(frame: List[Any], source: str) -> DiagramItem:
+    name, args, kwargs, _, at = frame
+    build, params = REPR_CONSTRUCTORS[name]
+    where = _sourceLocation(source, at)
+    callArgs: List[Any] = []
+    callKwargs: Dict[str, Any] = {}
+    args = list(args)
+    # Parameters before a variadic one are passed positionally, and those after it by keyword.
+    variadic = any(kind == "items" for _, kind in params)
+    beforeVariadic = variadic
+    for param, kind in params:
+        if kind == "items":
+            values, args = args, []
+            beforeVariadic = False
+        elif args:
+            if param in kwargs:
+                raise ValueError(f"{name}() got {param!r} twice{where}.")
+            values = [args.pop(0)]
+        elif param in kwargs:
+            values = [kwargs[param]]
+        elif beforeVariadic or kind == "item":
+            raise ValueError(f"{name}() is missing its {param!r} argument{where}.")
+        else:
+            continue
+        for value in values:
+            if not _reprValueOk(kind, value):
+                raise ValueError(f"Invalid {param!r} argument {value!r} for {name}(){where}.")
+        if kind == "items" or beforeVariadic:
+            callArgs.extend(values)
+        else:
+            callKwargs[param] = values[0]
+    if args:
+        raise ValueError(f"Too many arguments for {name}(){where}.")
+    unknown = set(kwargs) - {param for param, kind in params if kind != "items"}
+    if unknown:
+        raise ValueError(f"Unknown argument {sorted(unknown)[0]!r} for {name}(){where}.")
+    if variadic:
+        itemCount = len(callArgs) - [kind for _, kind in params].index("items")
+        if name == "AlternatingSequence" and itemCount != 2:
+            raise ValueError(f"AlternatingSequence() needs exactly two items, but got {itemCount}{where}.")
+        if itemCount == 0:
+            raise ValueError(f"{name}() needs at least one item{where}.")
+        if name in ("Choice", "MultipleChoice") and not 0 <= callArgs[0] < itemCount:
+            raise ValueError(f"{name}() default {callArgs[0]} isn't the index of one of its {itemCount} items{where}.")
+        if name == "MultipleChoice" and callArgs[1] not in ("any", "all"):
+            raise ValueError(f"MultipleChoice() type must be 'any' or 'all'{where}.")
+    try:
+        return build(*callArgs, **callKwargs)
+    except Exception as err:  # pylint: disable=broad-except
+        # Anything the checks above missed, like MultipleChoice's asserted type.
+        raise ValueError(f"Invalid arguments for {name}(){where}: {type(err).__name__}: {err}") from err
+
+
+def _reprValueOk(kind: str, value: Any) -> bool:
+    if kind in ("item", "items"):
+        return isinstance(value, (DiagramItem, str))
+    if kind == "item?":
+        return value is None or isinstance(value, (DiagramItem, str))
+    if kind == "int":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if kind == "str":
+        return isinstance(value, str)
+    if kind == "str?":
+        return value is None or isinstance(value, str)
+    # JS spells Optional(x, true) as Optional(x, 'skip').
+    return isinstance(value, bool) or value == "skip"
+
+
+_TEXT_PARAMS = (("text", "str"), ("href", "str?"), ("title", "str?"), ("cls", "str"))
+
+# The constructors fromRepr() accepts, with each one's parameters and their kinds.
+REPR_CONSTRUCTORS: Dict[str, Tuple[Callable[..., DiagramItem], Tuple[Tuple[str, str], ...]]] = {
+    "Diagram": (Diagram, (("items", "items"), ("type", "str"))),
+    "Sequence": (Sequence, (("items", "items"),)),
+    "Stack": (Stack, (("items", "items"),)),
+    "OptionalSequence": (OptionalSequence, (("items", "items"),)),
+    "AlternatingSequence": (AlternatingSequence, (("items", "items"),)),
+    "Choice": (Choice, (("default", "int"), ("items", "items"))),
+    "MultipleChoice": (MultipleChoice, (("default", "int"), ("type", "str"), ("items", "items"))),
+    "HorizontalChoice": (HorizontalChoice, (("items", "items"),)),
+    "Optional": (Optional, (("item", "item"), ("skip", "bool"))),
+    "OneOrMore": (OneOrMore, (("item", "item"), ("repeat", "item?"))),
+    "ZeroOrMore": (ZeroOrMore, (("item", "item"), ("repeat", "item?"), ("skip", "bool"))),
+    "Group": (Group, (("item", "item"), ("label", "item?"))),
+    "Start": (Start, (("type", "str"), ("label", "str?"))),
+    "End": (End, (("type", "str"),)),
+    "Terminal": (Terminal, _TEXT_PARAMS),
+    "NonTerminal": (NonTerminal, _TEXT_PARAMS),
+    "Comment": (Comment, _TEXT_PARAMS),
+    "Skip": (Skip, ()),
+}
+
+# W3C-style EBNF, as used in the XML and related specs:
+#   [1] name ::= expression  /* comment */  [ wfc: constraint ]
+EBNF_TOKENS = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>/\*.*?\*/)
+    | (?P<constraint>\[\s*(?:wfc|vc|WFC|VC)\s*:[^\]]*\])
+    | (?P<defines>::=)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    | (?P<string>"[^"]*"|'[^']*')
+    | (?P<charclass>\[[^\]]*\])
+    | (?P<hex>\#x[0-9A-Fa-f]+)
+    | (?P<punct>[()|?*+-])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+EBNF_LABEL = re.compile(r"\[\d+\]")
+
+
+def fromEbnf(source: str, href: Opt[str] = "#{}") -> Dict[str, Diagram]:
+    """
+    Parse a W3C-style EBNF grammar and return a Diagram for each production, keyed by its name.
+
+    References to other productions become NonTerminals linking to them,
+    with the href made by formatting the name into the href string (or no link, if it's None).
+    Production numbers like "[1]", comments, and well-formedness/validity constraints are dropped.
+    """
+    tokens: List[Tuple[str, str, int]] = []
+    pos = 0
+    while pos < len(source):
+        match = EBNF_TOKENS.match(source, pos)
+        if match is None:
+            raise ValueError(f"Unexpected character {source[pos]!r} in EBNF{_sourceLocation(source, pos)}.")
+        kind = match.lastgroup
+        assert kind is not None
+        if kind not in ("space", "comment", "constraint"):
+            tokens.append((kind, match.group(), pos))
+        pos = match.end()
+    tokens.append(("end", "", len(source)))
+
+    # Production names are needed up front, to know which references to link.
+    names = {
+        tokens[i][1]
+        for i in range(len(tokens) - 1)
+        if tokens[i][0] == "name" and tokens[i + 1][0] == "defines"
+    }
+    i = 0
+
+    def startsProduction(j: int) -> bool:
+        if tokens[j][0] == "charclass" and EBNF_LABEL.fullmatch(tokens[j][1]):
+            j += 1
+        return tokens[j][0] == "name" and tokens[j + 1][0] == "defines"
+
+    def fail(message: str) -> ValueError:
+        kind, text, at = tokens[i]
+        found = repr(text) if kind != "end" else "end of grammar"
+        return ValueError(f"{message}, but found {found}{_sourceLocation(source, at)}.")
+
+    def parseChoice() -> List[List[DiagramItem]]:
+        nonlocal i
+        alternatives = [parseSequence()]
+        while tokens[i][1] == "|":
+            i += 1
+            alternatives.append(parseSequence())
+        return alternatives
+
+    def parseSequence() -> List[DiagramItem]:
+        items = []
+        while tokens[i][0] != "end" and tokens[i][1] not in ("|", ")") and not startsProduction(i):
+            items.append(parseExclusion())
+        return items
+
+    def parseExclusion() -> DiagramItem:
+        nonlocal i
+        item = parsePostfix()
+        if tokens[i][1] == "-":
+            i += 1
+            start = i
+            parsePostfix()
+            excluded = " ".join(text for _, text, _ in tokens[start:i])
+            item = Group(item, f"except {excluded}")
+        return item
+
+    def parsePostfix() -> DiagramItem:
+        nonlocal i
+        item = parsePrimary()
+        while tokens[i][1] in ("?", "*", "+"):
+            op = tokens[i][1]
+            i += 1
+            if op == "?":
+                item = Optional(item)
+            elif op == "*":
+                item = ZeroOrMore(item)
+            else:
+                item = OneOrMore(item)
+        return item
+
+    def parsePrimary() -> DiagramItem:
+        nonlocal i
+        kind, text, _ = tokens[i]
+        if kind == "name":
+            i += 1
+            if text in names and href is not None:
+                return NonTerminal(text, href=href.format(text))
+            return NonTerminal(text)
+        if kind == "string":
+            i += 1
+            return Terminal(text[1:-1])
+        if kind in ("charclass", "hex"):
+            i += 1
+            return Terminal(text)
+        if text == "(":
+            i += 1
+            alternatives = parseChoice()
+            if tokens[i][1] != ")":
+                raise fail("Expected ')'")
+            i += 1
+            return _ebnfChoice(alternatives)
+        raise fail("Expected a name, string, character class, or '('")
+
+    diagrams: Dict[str, Diagram] = {}
+    while tokens[i][0] != "end":
+        if tokens[i][0] == "charclass" and EBNF_LABEL.fullmatch(tokens[i][1]):
+            i += 1
+        if not startsProduction(i):
+            raise fail("Expected a production like 'name ::= ...'")
+        name = tokens[i][1]
+        if name in diagrams:
+            raise ValueError(f"Production {name!r} is defined twice{_sourceLocation(source, tokens[i][2])}.")
+        i += 2
+        start = tokens[i][2]
+        try:
+            alternatives = parseChoice()
+        except RecursionError:
+            # The parser recurses once per level of parentheses.
+            raise ValueError(f"Production {name!r} is nested too deeply{_sourceLocation(source, start)}.") from None
+        if len(alternatives) == 1:
+            diagrams[name] = Diagram(*(alternatives[0] or [Skip()]))
+        else:
+            diagrams[name] = Diagram(_ebnfChoice(alternatives))
+    return diagrams
+
+
+def _ebnfChoice(alternatives: List[List[DiagramItem]]) -> DiagramItem:
+    items = [_ebnfSequence(items) for items in alternatives]
+    return items[0] if len(items) == 1 else Choice(0, *items)
+
+
+def _ebnfSequence(items: List[DiagramItem]) -> DiagramItem:
+    if not items:
+        return Skip()
+    return items[0] if len(items) == 1 else Sequence(*items)
+
+
+def _sourceLocation(source: str, pos: int) -> str:
+    line = source.count("\n", 0, pos) + 1
+    column = pos - (source.rfind("\n", 0, pos) + 1) + 1
+    return f" at line {line}, column {column}"
+
+
+def fromRegex(pattern: str, flags: int = 0) -> Diagram:
+    """
+    Build a Diagram of a Python regular expression, parsed with the standard library's own regex parser.
+
+    Parsed patterns are cached by pattern and flags, so repeatedly rendering the same token is cheap.
+    What's cached is the Diagram's .toDict(), and each call builds a new Diagram from it,
+    since formatting a Diagram changes it.
+    While a Budget is being enforced, the cache isn't used,
+    so that building the Diagram is counted against the budget.
+    """
+    if _activeBudget.get() is not None:
+        return _buildRegexDiagram(pattern, flags)
+    diagram = fromDict(_cachedRegexDict(pattern, flags), maxDepth=sys.maxsize, maxNodes=sys.maxsize)
+    assert isinstance(diagram, Diagram)
+    return diagram
+
+
+def _buildRegexDiagram(pattern: str, flags: int) -> Diagram:
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+        # .state in 3.11+, .pattern before that.
+        state = getattr(parsed, "state", None) or parsed.pattern
+        groupNames = {index: name for name, index in state.groupdict.items()}
+        items = _regexItems(parsed, groupNames)
+    except re.error as err:
+        raise ValueError(f"Invalid regex {pattern!r}: {err}") from err
+    except RecursionError:
+        # Both the regex parser and _regexItems() recurse once per level of nesting.
+        raise ValueError("The regex is nested too deeply to diagram.") from None
+    # Flags set for the whole pattern, by argument or (?i)-style, are noted at its start.
+    flagNames = _regexFlagNames(state.flags)
+    if flagNames:
+        items.insert(0, Comment(flagNames))
+    return Diagram(*(items or [Skip()]))
+
+
+@functools.lru_cache(maxsize=256)
+def _cachedRegexDict(pattern: str, flags: int) -> Dict[str, Any]:
+    # Only ever read, by fromDict().
+    return _buildRegexDiagram(pattern, flags).toDict()
+
+
+# The flags that change what a regex matches (rather than how it's written), and how to describe them.
+REGEX_FLAGS = {
+    re.IGNORECASE: "case-insensitive",
+    re.MULTILINE: "^ and $ match at lines",
+    re.DOTALL: ". matches newlines",
+}
+
+
+def _regexFlagNames(flags: int) -> str:
+    return ", ".join(name for flag, name in REGEX_FLAGS.items() if flags & flag)
+
+
+REGEX_CATEGORIES = {
+    "CATEGORY_DIGIT": "digit",
+    "CATEGORY_NOT_DIGIT": "non-digit",
+    "CATEGORY_SPACE": "whitespace",
+    "CATEGORY_NOT_SPACE": "non-whitespace",
+    "CATEGORY_WORD": "word character",
+    "CATEGORY_NOT_WORD": "non-word character",
+}
+REGEX_CLASS_ESCAPES = {
+    "CATEGORY_DIGIT": "\\d",
+    "CATEGORY_NOT_DIGIT": "\\D",
+    "CATEGORY_SPACE": "\\s",
+    "CATEGORY_NOT_SPACE": "\\S",
+    "CATEGORY_WORD": "\\w",
+    "CATEGORY_NOT_WORD": "\\W",
+}
+REGEX_ANCHORS = {
+    "AT_BEGINNING": "start of line",
+    "AT_BEGINNING_LINE": "start of line",
+    "AT_BEGINNING_STRING": "start of string",
+    "AT_END": "end of line",
+    "AT_END_LINE": "end of line",
+    "AT_END_STRING": "end of string",
+    "AT_BOUNDARY": "word boundary",
+    "AT_NON_BOUNDARY": "not a word boundary",
+}
+
+
+def _regexItems(subpattern: Any, groupNames: Dict[int, str]) -> List[DiagramItem]:
+    # Converts a parsed regex (a list of (opcode, argument) pairs) into diagram items,
+    # merging runs of literal characters into a single Terminal.
+    items: List[DiagramItem] = []
+    literal = ""
+    for op, av in subpattern:
+        opName = str(op)
+        if opName == "LITERAL":
+            literal += chr(av)
+            continue
+        if literal:
+            items.append(Terminal(literal))
+            literal = ""
+        items.append(_regexItem(opName, av, groupNames))
+    if literal:
+        items.append(Terminal(literal))
+    return items
+
+
+def _regexSequence(subpattern: Any, groupNames: Dict[int, str]) -> DiagramItem:
+    items = _regexItems(subpattern, groupNames)
+    if not items:
+        return Skip()
+    return items[0] if len(items) == 1 else Sequence(*items)
+
+
+def _regexItem(opName: str, av: Any, groupNames: Dict[int, str]) -> DiagramItem:
+    if opName == "NOT_LITERAL":
+        return NonTerminal(f"not {chr(av)!r}")
+    if opName == "ANY":
+        return NonTerminal("any character")
+    if opName == "IN":
+        return _regexClass(av)
+    if opName == "BRANCH":
+        _, branches = av
+        return Choice(0, *(_regexSequence(branch, groupNames) for branch in branches))
+    if opName == "SUBPATTERN":
+        group, addFlags, delFlags, subpattern = av
+        item = _regexSequence(subpattern, groupNames)
+        # Scoped flags, like (?i:...), label a group of their own.
+        flagNames = ", ".join(
+            filter(None, [_regexFlagNames(addFlags), _regexFlagNames(delFlags) and "not " + _regexFlagNames(delFlags)])
+        )
+        if flagNames:
+            item = Group(item, flagNames)
+        if group is None:
+            return item
+        return Group(item, groupNames.get(group, f"group {group}"))
+    if opName in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+        low, high, subpattern = av
+        return _regexRepeat(_regexSequence(subpattern, groupNames), low, high)
+    if opName == "AT":
+        return Comment(REGEX_ANCHORS.get(str(av), str(av)))
+    if opName == "GROUPREF":
+        return NonTerminal(f"same as {groupNames.get(av, f'group {av}')}")
+    if opName in ("ASSERT", "ASSERT_NOT"):
+        direction, subpattern = av
+        label = "followed by" if direction == 1 else "preceded by"
+        if opName == "ASSERT_NOT":
+            label = "not " + label
+        return Group(_regexSequence(subpattern, groupNames), label)
+    if opName == "ATOMIC_GROUP":
+        return Group(_regexSequence(av, groupNames), "atomic")
+    if opName == "GROUPREF_EXISTS":
+        group, yes, no = av
+        name = groupNames.get(group, f"group {group}")
+        return Choice(
+            0,
+            Group(_regexSequence(yes, groupNames), f"if {name} matched"),
+            Group(_regexSequence(no or [], groupNames), "otherwise"),
+        )
+    raise ValueError(f"Can't diagram regex opcode {opName}.")
+
+
+def _regexClass(members: Any) -> DiagramItem:
+    # A lone category (\d, \s, etc) gets a readable name;
+    # anything else is shown as a [...] character class.
+    if len(members) == 1 and str(members[0][0]) == "CATEGORY":
+        category = str(members[0][1])
+        return NonTerminal(REGEX_CATEGORIES.get(category, category))
+    text = ""
+    for op, av in members:
+        opName = str(op)
+        if opName == "NEGATE":
+            text += "^"
+        elif opName == "LITERAL":
+            text += _regexClassChar(av)
+        elif opName == "RANGE":
+            text += f"{_regexClassChar(av[0])}-{_regexClassChar(av[1])}"
+        elif opName == "CATEGORY":
+            text += REGEX_CLASS_ESCAPES.get(str(av), str(av))
+        else:
+            raise ValueError(f"Can't diagram regex character class member {opName}.")
+    return NonTerminal(f"[{text}]")
+
+
+def _regexClassChar(code: int) -> str:
+    char = chr(code)
+    if char in "\\]^-":
+        return "\\" + char
+    if not char.isprintable():
+        return char.encode("unicode_escape").decode("ascii")
+    return char
+
+
+def _regexRepeat(item: DiagramItem, low: int, high: int) -> DiagramItem:
+    unbounded = high == sre_parse.MAXREPEAT
+    if (low, high) == (0, 1):
+        return Optional(item)
+    if low == high:
+        if low == 0:
+            return Skip()
+        if low == 1:
+            return item
+        return OneOrMore(item, Comment(f"{low} times"))
+    if unbounded:
+        if low == 0:
+            return ZeroOrMore(item)
+        if low == 1:
+            return OneOrMore(item)
+        return OneOrMore(item, Comment(f"{low}+ times"))
+    if low == 0:
+        return Optional(OneOrMore(item, Comment(f"at most {high} times")))
+    return OneOrMore(item, Comment(f"{low}-{high} times"))
+
+
+def _normalized(item: DiagramItem, leftFactor: bool) -> Opt[DiagramItem]:
+    # A simpler item describing the same language, for DiagramItem.normalize(),
+    # given that the item's children are already normalized; None if it's already as simple as it gets.
+    if isinstance(item, Sequence):
+        result = _sequenceOf(item.items)
+        if isinstance(result, Sequence) and _sameItems(result.items, item.items):
+            return None
+        return result
+    if isinstance(item, Choice):
+        alternatives, default = _mergedAlternatives(item)
+        if leftFactor:
+            alternatives, default = _leftFactored(alternatives, default)
+        if len(alternatives) == 1:
+            return alternatives[0]
+        if _sameItems(alternatives, item.items) and default == item.default:
+            return None
+        return Choice(default, *alternatives)
+    if isinstance(item, HorizontalChoice):
+        unique: Dict[str, DiagramItem] = {}
+        for alternative in item.items:
+            unique.setdefault(alternative.fingerprint(), alternative)
+        alternatives = list(unique.values())
+        if len(alternatives) == len(item.items):
+            return None
+        return alternatives[0] if len(alternatives) == 1 else HorizontalChoice(*alternatives)
+    return None
+
+
+def _sameItems(a: Seq[DiagramItem], b: Seq[DiagramItem]) -> bool:
+    return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+
+def _sequenceOf(items: Seq[DiagramItem]) -> DiagramItem:
+    # The items in a row, with nested Sequences flattened and Skips dropped.
+    flat: List[DiagramItem] = []
+    for item in items:
+        if isinstance(item, Sequence):
+            flat.extend(child for child in item.items if not isinstance(child, Skip))
+        elif not isinstance(item, Skip):
+            flat.append(item)
+    if not flat:
+        return Skip()
+    return flat[0] if len(flat) == 1 else Sequence(*flat)
+
+
+def _mergedAlternatives(choice: Choice) -> Tuple[List[DiagramItem], int]:
+    # The choice's alternatives, with nested Choices merged in and duplicates removed,
+    # and the index of the one that was the default.
+    alternatives: List[DiagramItem] = []
+    seen: Dict[str, int] = {}
+    default = 0
+    for i, item in enumerate(choice.items):
+        nested = item.items if isinstance(item, Choice) else [item]
+        nestedDefault = item.default if isinstance(item, Choice) else 0
+        for j, alternative in enumerate(nested):
+            key = alternative.fingerprint()
+            if key not in seen:
+                seen[key] = len(alternatives)
+                alternatives.append(alternative)
+            if i == choice.default and j == nestedDefault:
+                default = seen[key]
+    return alternatives, default
+
+
+def _leftFactored(alternatives: List[DiagramItem], default: int) -> Tuple[List[DiagramItem], int]:
+    # Alternatives that start with the same item are pulled together,
+    # at the position of the first of them,
+    # into one Sequence of their common prefix followed by a Choice of what's left of each.
+    parts = [item.items if isinstance(item, Sequence) else [] if isinstance(item, Skip) else [item] for item in alternatives]
+    groups: Dict[Any, List[int]] = {}
+    for i, itemParts in enumerate(parts):
+        groups.setdefault(itemParts[0].fingerprint() if itemParts else i, []).append(i)
+    if len(groups) == len(alternatives):
+        return alternatives, default
+    factored: List[DiagramItem] = []
+    newDefault = 0
+    for members in groups.values():
+        if default in members:
+            newDefault = len(factored)
+        if len(members) == 1:
+            factored.append(alternatives[members[0]])
+            continue
+        prefixLength = 1
+        shortest = min(len(parts[i]) for i in members)
+        while prefixLength < shortest and len({parts[i][prefixLength].fingerprint() for i in members}) == 1:
+            prefixLength += 1
+        rests = [_sequenceOf(parts[i][prefixLength:]) for i in members]
+        rest: DiagramItem = Choice(members.index(default) if default in members else 0, *rests)
+        rest = _normalized(rest, True) or rest
+        factored.append(_sequenceOf([*parts[members[0]][:prefixLength], rest]))
+    return factored, newDefault
+
+
+class DiagramIndex:
+    """
+    An index of the text items (Terminals, NonTerminals, and Comments) in a set of named diagrams,
+    by their text, href, and classes, so cross-reference lookups don't have to walk every diagram.
+
+    Each lookup returns {diagram name: [Visit, ...]}, giving every matching item and where it is in that diagram.
+    Diagrams can be added, replaced, and removed at any time, and only that diagram is re-indexed.
+    """
+
+    def __init__(self, diagrams: Opt[Dict[str, DiagramItem]] = None):
+        self.diagrams: Dict[str, DiagramItem] = {}
+        self.texts: Dict[str, Dict[str, List[Visit]]] = {}
+        self.hrefs: Dict[str, Dict[str, List[Visit]]] = {}
+        self.classes: Dict[str, Dict[str, List[Visit]]] = {}
+        # Just the NonTerminals, by text, for usedBy().
+        self.references: Dict[str, Dict[str, List[Visit]]] = {}
+        # The (map, key) of every entry each diagram has, so it can be removed without another walk.
+        self.entries: Dict[str, List[Tuple[Dict[str, Dict[str, List[Visit]]], str]]] = {}
+        for name, diagram in (diagrams or {}).items():
+            self.add(name, diagram)
+
+    def add(self, name: str, diagram: DiagramItem) -> None:
+        # Index the diagram under the name, replacing any diagram already there.
+        self.remove(name)
+        self.diagrams[name] = diagram
+        entries = self.entries[name] = []
+
+        def note(index: Dict[str, Dict[str, List[Visit]]], key: str, visit: Visit) -> None:
+            visits = index.setdefault(key, {})
+            if name not in visits:
+                visits[name] = []
+                entries.append((index, key))
+            visits[name].append(visit)
+
+        for visit in diagram.iterate():
+            item = visit.item
+            if not isinstance(item, (Terminal, NonTerminal, Comment)):
+                continue
+            note(self.texts, item.text, visit)
+            if isinstance(item, NonTerminal):
+                note(self.references, item.text, visit)
+            if item.href is not None:
+                note(self.hrefs, item.href, visit)
+            for cls in set(item.cls.split()):
+                note(self.classes, cls, visit)
+
+    def remove(self, name: str) -> None:
+        # Drop the named diagram from the index, if it's there.
+        if name not in self.diagrams:
+            return
+        del self.diagrams[name]
+        for index, key in self.entries.pop(name):
+            visits = index[key]
+            del visits[name]
+            if not visits:
+                del index[key]
+
+    def withText(self, text: str) -> Dict[str, List[Visit]]:
+        return _copiedVisits(self.texts, text)
+
+    def withHref(self, href: str) -> Dict[str, List[Visit]]:
+        return _copiedVisits(self.hrefs, href)
+
+    def withClass(self, cls: str) -> Dict[str, List[Visit]]:
+        return _copiedVisits(self.classes, cls)
+
+    def usedBy(self, rule: str) -> List[str]:
+        # The names of the diagrams with a NonTerminal referring to the rule.
+        return list(self.references.get(rule, {}))
+
+    def uses(self, name: str) -> List[str]:
+        # The rules the named diagram's NonTerminals refer to.
+        return [key for index, key in self.entries.get(name, []) if index is self.references]
+
+
+def _copiedVisits(index: Dict[str, Dict[str, List[Visit]]], key: str) -> Dict[str, List[Visit]]:
+    # A DiagramIndex lookup result, copied so that changing it can't change the index.
+    return {name: list(visits) for name, visits in index.get(key, {}).items()}
+
+
+class Profiler:
+    """
+    Opt-in timing of the library's work, per item class and method:
+    construction (__init__), layout (format), SVG serialization (writeSvg, writeStandalone),
+    and text layout (textDiagram, writeText).
+
+    While a Profiler is active (as a context manager, or between .enable() and .disable()),
+    those methods on DiagramItem and all its subclasses are wrapped to record
+    call counts, time spent in each method itself, and cumulative time including what it calls.
+    Outside of that the methods aren't touched, so there's no cost at all.
+    If a sink is given, it's also called with (name, phase, seconds) after every call.
+    Only one Profiler can be active at a time, and it sees calls from every thread.
+    """
+
+    PHASES = {
+        "__init__": "construction",
+        "format": "layout",
+        "writeSvg": "serialization",
+        "writeStandalone": "serialization",
+        "textDiagram": "text",
+        "writeText": "text",
+    }
+    active: Opt[Profiler] = None
+
+    def __init__(self, sink: Opt[Callable[[str, str, float], Any]] = None):
+        self.sink = sink
+        # For each "Class.method": [calls, own seconds, cumulative seconds, phase].
+        self.stats: Dict[str, List[Any]] = {}
+        self.originals: List[Tuple[type, str, Any]] = []
+        self.local = threading.local()
+
+    def __enter__(self) -> Profiler:
+        self.enable()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.disable()
+
+    def enable(self) -> None:
+        if Profiler.active is not None:
+            raise RuntimeError("Another Profiler is already active.")
+        Profiler.active = self
+        classes = [DiagramItem]
+        for cls in classes:
+            classes.extend(cls.__subclasses__())
+            for name, phase in self.PHASES.items():
+                if name in cls.__dict__:
+                    original = cls.__dict__[name]
+                    self.originals.append((cls, name, original))
+                    setattr(cls, name, self._wrap(f"{cls.__name__}.{name}", phase, original))
+
+    def disable(self) -> None:
+        for cls, name, original in reversed(self.originals):
+            setattr(cls, name, original)
+        self.originals = []
+        if Profiler.active is self:
+            Profiler.active = None
+
+    def _wrap(self, key: str, phase: str, method: Callable[..., Any]) -> Callable[..., Any]:
+        stat = self.stats.setdefault(key, [0, 0.0, 0.0, phase])
+        local = self.local
+        sink = self.sink
+        clock = time.perf_counter
+
+        @functools.wraps(method)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not hasattr(local, "childTimes"):
+                local.childTimes = []
+                local.depths = {}
+            # Time spent in instrumented callees, to subtract from this call's own time.
+            local.childTimes.append(0.0)
+            local.depths[key] = local.depths.get(key, 0) + 1
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                childTime = local.childTimes.pop()
+                if local.childTimes:
+                    local.childTimes[-1] += elapsed
+                local.depths[key] -= 1
+                stat[0] += 1
+                stat[1] += elapsed - childTime
+                # Like pstats, recursive calls only count once toward the cumulative time.
+                if not local.depths[key]:
+                    stat[2] += elapsed
+                if sink is not None:
+                    sink(key, phase, elapsed)
+
+        return wrapper
+
+    def phases(self) -> Dict[str, Tuple[int, float]]:
+        # The calls and time for each phase, attributing each bit of time to only the innermost method.
+        totals: Dict[str, Tuple[int, float]] = {}
+        for calls, own, _, phase in self.stats.values():
+            phaseCalls, phaseTime = totals.get(phase, (0, 0.0))
+            totals[phase] = (phaseCalls + calls, phaseTime + own)
+        return totals
+
+    def dump(self, write: WriterF = sys.stdout.write, sort: str = "cumulative", limit: Opt[int] = None) -> None:
+        # A table like pstats' print_stats(), sorted by "cumulative", "own", "calls", or "name".
+        column = {"calls": 0, "own": 1, "cumulative": 2}
+        rows = [(key, stat) for key, stat in self.stats.items() if stat[0]]
+        if sort == "name":
+            rows.sort()
+        else:
+            rows.sort(key=lambda row: row[1][column[sort]], reverse=True)
+        write(f"{'ncalls':>10} {'tottime':>10} {'cumtime':>10}  {'phase':<14} method\n")
+        for key, (calls, own, cumulative, phase) in rows[:limit]:
+            write(f"{calls:>10} {own:>10.4f} {cumulative:>10.4f}  {phase:<14} {key}\n")
+        for phase, (calls, seconds) in sorted(self.phases().items()):
+            write(f"{phase}: {calls} calls, {seconds:.4f}s\n")
+
+
+RENDER_FORMATS = ("svg", "standalone", "ascii", "unicode")
+
+# The module-level options, which worker processes need copied over from the parent.
+CONFIG_OPTIONS = (
+    "DEBUG",
+    "VS",
+    "AR",
+    "DIAGRAM_CLASS",
+    "STROKE_ODD_PIXEL_LENGTH",
+    "INTERNAL_ALIGNMENT",
+    "CHAR_WIDTH",
+    "COMMENT_CHAR_WIDTH",
+    "ESCAPE_HTML",
+    "DEFAULT_STYLE",
+)
+
+
+def render(diagram: Diagram, format: str = "svg", cache: Opt[RenderCacheT] = None) -> str:
+    """
+    Render a diagram to a string, in one of RENDER_FORMATS:
+    "svg" and "standalone" as from .writeSvg() and .writeStandalone(),
+    or "ascii" and "unicode" as from .writeText() with those characters.
+    If a cache is given, the output is looked up in and stored to it.
+    Several threads can render the same diagram at once; they take turns.
+    """
+    if format not in RENDER_FORMATS:
+        raise ValueError(f"Unknown render format {format!r}; expected one of {', '.join(RENDER_FORMATS)}.")
+    chunks: List[str] = []
+    # Formatting and writing change the diagram in place, so threads rendering it take turns.
+    with _renderLock(diagram):
+        if format == "svg":
+            diagram.writeSvg(chunks.append, cache=cache)
+        elif format == "standalone":
+            diagram.writeStandalone(chunks.append, cache=cache)
+        else:
+            # The characters are a class-level setting, so threads rendering text take turns too.
+            with _textPartsLock:
+                parts = TextDiagram.parts
+                TextDiagram.setFormatting(TextDiagram.PARTS_ASCII if format == "ascii" else TextDiagram.PARTS_UNICODE)
+                try:
+                    diagram.writeText(chunks.append, cache=cache)
+                finally:
+                    TextDiagram.parts = parts
+    return "".join(chunks)
+
+
+_textPartsLock = threading.Lock()
+# The lock each diagram is rendered under, for as long as the diagram exists.
+_renderLocks: weakref.WeakKeyDictionary[Diagram, threading.Lock] = weakref.WeakKeyDictionary()
+_renderLocksLock = threading.Lock()
+
+
+def _renderLock(diagram: Diagram) -> threading.Lock:
+    with _renderLocksLock:
+        lock = _renderLocks.get(diagram)
+        if lock is None:
+            lock = _renderLocks[diagram] = threading.Lock()
+        return lock
+
+
+async def renderAsync(
+    diagram: Diagram,
+    format: str = "svg",
+    executor: Opt[futures.Executor] = None,
+    cache: Opt[RenderCacheT] = None,
+) -> str:
+    """
+    Like render(), but run in an executor (the event loop's default thread pool, if not given),
+    so formatting and serializing a large diagram doesn't block the event loop.
+    Concurrent renders of the same diagram take turns, as with render().
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    return await asyncio.get_running_loop().run_in_executor(executor, render, diagram, format, cache)
+
+
+async def writeAsync(
+    diagram: Diagram,
+    writer: asyncio.StreamWriter,
+    format: str = "svg",
+    executor: Opt[futures.Executor] = None,
+    chunkSize: int = 64 * 1024,
+    cache: Opt[RenderCacheT] = None,
+) -> None:
+    """
+    Render the diagram with renderAsync(), then write it to the writer as UTF-8
+    in chunkSize-byte pieces, waiting on writer.drain() after each,
+    so a slow reader only holds up its own response.
+    """
+    data = (await renderAsync(diagram, format, executor, cache)).encode("utf-8")
+    view = memoryview(data)
+    for start in range(0, len(data), chunkSize):
+        writer.write(view[start : start + chunkSize])
+        await writer.drain()
+
+
+def renderMany(
+    diagrams: Iterable[Diagram],
+    format: str = "svg",
+    jobs: Opt[int] = None,
+    chunksize: Opt[int] = None,
+    cache: Opt[RenderCacheT] = None,
+) -> List[Union[str, Exception]]:
+    """
+    Render many diagrams with render(), across a pool of `jobs` processes
+    (defaulting to one per CPU; 1 renders in this process instead).
+
+    Returns the results in the same order as the diagrams.
+    A diagram that fails to render doesn't stop the batch:
+    its result is the exception it raised, rather than a string.
+    The workers use this process's current module options and text characters.
+    Each worker gets its own copy of the cache, if one is given,
+    so it's only shared between them if it's stored outside the process, like a DiskCache.
+    """
+    if format not in RENDER_FORMATS:
+        raise ValueError(f"Unknown render format {format!r}; expected one of {', '.join(RENDER_FORMATS)}.")
+    diagrams = list(diagrams)
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(diagrams) <= 1:
+        return [_renderOrError(diagram, format, cache) for diagram in diagrams]
+
+    from concurrent import futures  # pylint: disable=import-outside-toplevel
+
+    # Pickle up front, so one diagram that can't be pickled only fails itself.
+    results: List[Union[str, Exception, None]] = [None] * len(diagrams)
+    pickled: List[Tuple[int, bytes]] = []
+    for i, diagram in enumerate(diagrams):
+        try:
+            pickled.append((i, pickle.dumps(diagram)))
+        except Exception as err:  # pylint: disable=broad-except
+            results[i] = err
+    if chunksize is None:
+        # A few chunks per worker, to balance uneven diagram sizes without too much overhead.
+        chunksize = max(1, len(pickled) // (jobs * 4))
+    with futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_applyConfig, initargs=(_configSnapshot(),)
+    ) as pool:
+        rendered = pool.map(
+            _renderPickled,
+            [data for _, data in pickled],
+            itertools.repeat(format),
+            itertools.repeat(cache),
+            chunksize=chunksize,
+        )
+        for (i, _), result in zip(pickled, rendered):
+            results[i] = result
+    return results  # type: ignore[return-value]
+
+
+def _renderOrError(diagram: Diagram, format: str, cache: Opt[RenderCacheT] = None) -> Union[str, Exception]:
+    try:
+        return render(diagram, format, cache)
+    except Exception as err:  # pylint: disable=broad-except
+        return err
+
+
+def _renderPickled(data: bytes, format: str, cache: Opt[RenderCacheT]) -> Union[str, Exception]:
+    try:
+        diagram = pickle.loads(data)
+    except Exception as err:  # pylint: disable=broad-except
+        return err
+    result = _renderOrError(diagram, format, cache)
+    if isinstance(result, Exception):
+        try:
+            pickle.dumps(result)
+        except Exception:  # pylint: disable=broad-except
+            # Send back what we can of an exception that can't cross the process boundary.
+            return RuntimeError(f"{type(result).__name__}: {result}")
+    return result
+
+
+def _configSnapshot() -> Dict[str, Any]:
+    snapshot = {name: globals()[name] for name in CONFIG_OPTIONS}
+    snapshot["TextDiagram.parts"] = dict(TextDiagram.parts)
+    return snapshot
+
+
+def _applyConfig(snapshot: Dict[str, Any]) -> None:
+    for name in CONFIG_OPTIONS:
+        globals()[name] = snapshot[name]
+    TextDiagram.parts = dict(snapshot["TextDiagram.parts"])
+
+
+# The file extension for each render format, in build output.
+# "svg" output is an inline <svg> element, without the namespace declarations a standalone .svg file needs,
+# meant to be pasted into an HTML page, so it gets .html; "standalone" output is the real .svg file.
+OUTPUT_EXTENSIONS = {
+    "svg": ".html",
+    "standalone": ".svg",
+    "ascii": ".ascii.txt",
+    "unicode": ".unicode.txt",
+}
+BUILD_MANIFEST = ".railroad-manifest.json"
+
+
+@functools.lru_cache(maxsize=None)
+def libraryVersion() -> str:
+    # Identifies this exact copy of the library, for keying caches of rendered output:
+    # the package version, plus a hash of this file so local edits count too.
+    try:
+        from importlib import metadata  # pylint: disable=import-outside-toplevel
+
+        version = metadata.version("railroad-diagrams")
+    except Exception:  # pylint: disable=broad-except
+        version = "unknown"
+    try:
+        with open(__file__, "rb") as fh:
+            return f"{version}+{hashlib.sha1(fh.read()).hexdigest()[:12]}"
+    except OSError:
+        return version
+
+
+def renderKey(diagram: DiagramItem, format: str) -> str:
+    # A key for a diagram's rendered output: its structure, the format, the options, and the library version.
+    source = f"{diagram.fingerprint()}\n{format}\n{configKey()!r}\n{libraryVersion()}"
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def loadDiagrams(path: str, href: Opt[str] = "#{}") -> Dict[str, Diagram]:
+    """
+    Load diagrams from a file, keyed by name.
+
+    A .json file holds either a single diagram as from .toDict() (named after the file),
+    or an object mapping names to such diagrams.
+    Anything else is read as a W3C-style EBNF grammar, with one diagram per production (see fromEbnf()).
+    """
+    with open(path, "r", encoding="utf-8") as fh:
+        source = fh.read()
+    if not path.lower().endswith(".json"):
+        return fromEbnf(source, href=href)
+    try:
+        data = json.loads(source)
+    except ValueError as err:
+        raise ValueError(f"Invalid diagram JSON: {err}") from err
+    if isinstance(data, dict) and "kind" in data:
+        data = {os.path.splitext(os.path.basename(path))[0]: data}
+    if not isinstance(data, dict):
+        raise ValueError("Expected a diagram, or an object mapping names to diagrams.")
+    diagrams = {}
+    for name, itemData in data.items():
+        item = fromDict(itemData)
+        diagrams[name] = item if isinstance(item, Diagram) else Diagram(item)
+    return diagrams
+
+
+def buildDiagrams(
+    inputs: Seq[str],
+    outputDir: str,
+    formats: Seq[str] = ("standalone",),
+    jobs: Opt[int] = None,
+    href: Opt[str] = "#{}",
+    force: bool = False,
+    log: Callable[[str], Any] = print,
+    cache: Opt[RenderCacheT] = None,
+) -> Tuple[int, int, int]:
+    """
+    Render every diagram in the input files (see loadDiagrams()) into outputDir,
+    one file per diagram per format, named after the diagram.
+
+    A manifest in outputDir records the renderKey() of each output file,
+    and outputs whose key hasn't changed since the last build (and still exist) are skipped,
+    unless `force` is true.
+    If every input loaded, outputs (in the formats being built) that earlier builds wrote
+    for diagrams that no longer exist are deleted.
+    Other outputs are rendered through `cache`, if given.
+    Returns the number of files (rendered, skipped, failed);
+    failures, and problems loading inputs, are reported through `log`.
+    """
+    diagrams, failed = _collectDiagrams(inputs, lambda path: loadDiagrams(path, href), log)
+    written, skipped, renderFailed = _renderDiagrams(diagrams, outputDir, formats, jobs, force, log, cache, not failed)
+    return len(written), skipped, failed + renderFailed
+
+
+def watchDiagrams(
+    inputs: Seq[str],
+    outputDir: str,
+    formats: Seq[str] = ("standalone",),
+    jobs: Opt[int] = None,
+    href: Opt[str] = "#{}",
+    log: Callable[[str], Any] = print,
+    cache: Opt[RenderCacheT] = None,
+    interval: float = 0.2,
+    stop: Opt[threading.Event] = None,
+) -> None:
+    """
+    Build like buildDiagrams(), then keep polling the inputs every `interval` seconds,
+    and rebuild whenever one of them changes, until `stop` is set (or forever).
+
+    Only inputs that changed are parsed again,
+    and only diagrams whose trees changed are rendered again,
+    in this process rather than a pool (which would take longer to start than the rendering takes).
+    Each rebuild logs the files it wrote.
+    """
+    # For each input, its stamp when it was last loaded, and what loading it gave.
+    loaded: Dict[str, Tuple[Any, Union[Dict[str, Diagram], Exception]]] = {}
+
+    def load(path: str) -> Dict[str, Diagram]:
+        stamp = _fileStamp(path)
+        if path not in loaded or loaded[path][0] != stamp:
+            try:
+                result: Union[Dict[str, Diagram], Exception] = loadDiagrams(path, href)
+            except (OSError, ValueError) as err:
+                result = err
+            loaded[path] = (stamp, result)
+        result = loaded[path][1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    stamps = None
+    while stop is None or not stop.is_set():
+        current = [_fileStamp(path) for path in inputs]
+        if current != stamps:
+            first = stamps is None
+            stamps = current
+            diagrams, failed = _collectDiagrams(inputs, load, log)
+            if failed and not first:
+                # Probably a half-finished edit; keep the last good outputs until the next save.
+                written: List[str] = []
+                skipped = renderFailed = 0
+            else:
+                written, skipped, renderFailed = _renderDiagrams(
+                    diagrams, outputDir, formats, jobs if first else 1, False, log, cache, not failed
+                )
+            if first:
+                log(f"Rendered {len(written)} files, skipped {skipped} unchanged, {failed + renderFailed} failed.")
+            elif written:
+                log(f"Updated {', '.join(written)}.")
+        if stop is None:
+            time.sleep(interval)
+        else:
+            stop.wait(interval)
+
+
+def _fileStamp(path: str) -> Opt[Tuple[int, int]]:
+    # Changes whenever the file is saved (or removed).
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _collectDiagrams(
+    inputs: Seq[str], load: Callable[[str], Dict[str, Diagram]], log: Callable[[str], Any]
+) -> Tuple[Dict[str, Diagram], int]:
+    # All the inputs' diagrams by name, and how many problems there were loading them.
+    diagrams: Dict[str, Diagram] = {}
+    failed = 0
+    for path in inputs:
+        try:
+            loaded = load(path)
+        except (OSError, ValueError) as err:
+            log(f"{path}: {err}")
+            failed += 1
+            continue
+        for name, diagram in loaded.items():
+            if name in diagrams:
+                log(f"{path}: diagram {name!r} is defined in more than one input")
+                failed += 1
+                continue
+            diagrams[name] = diagram
+    return diagrams, failed
+
+
+def _renderDiagrams(
+    diagrams: Dict[str, Diagram],
+    outputDir: str,
+    formats: Seq[str],
+    jobs: Opt[int],
+    force: bool,
+    log: Callable[[str], Any],
+    cache: Opt[RenderCacheT],
+    prune: bool = False,
+) -> Tuple[List[str], int, int]:
+    # Render the diagrams whose output has changed, per the manifest,
+    # returning the files written, and how many were skipped and failed.
+    # If prune is true, also delete the outputs of diagrams that are gone.
+    manifestPath = os.path.join(outputDir, BUILD_MANIFEST)
+    try:
+        with open(manifestPath, "r", encoding="utf-8") as fh:
+            manifest = json.load(fh)
+        if not isinstance(manifest, dict):
+            manifest = {}
+    except (OSError, ValueError):
+        manifest = {}
+    os.makedirs(outputDir, exist_ok=True)
+
+    written: List[str] = []
+    skipped = failed = 0
+    # Names that would still share a file (on a case-insensitive filesystem, say) fail rather than overwrite each other.
+    outputNames: Dict[str, str] = {}
+    claimed: Dict[str, str] = {}
+    for name in diagrams:
+        outputName = _outputName(name)
+        other = claimed.setdefault(outputName.lower(), name)
+        if other != name:
+            log(f"{outputName}: diagrams {other!r} and {name!r} would be written to the same files")
+            failed += len(formats)
+            continue
+        outputNames[name] = outputName
+    # Entries for outputs that aren't part of this build (say, from an input that failed to load) are kept.
+    newManifest: Dict[str, str] = dict(manifest)
+    for format in formats:
+        todo: List[Tuple[str, str, Diagram]] = []
+        for name, outputName in outputNames.items():
+            diagram = diagrams[name]
+            filename = outputName + OUTPUT_EXTENSIONS[format]
+            key = renderKey(diagram, format)
+            if not force and manifest.get(filename) == key and os.path.exists(os.path.join(outputDir, filename)):
+                skipped += 1
+            else:
+                todo.append((filename, key, diagram))
+        results = renderMany([diagram for _, _, diagram in todo], format, jobs=jobs, cache=cache)
+        for (filename, key, _), result in zip(todo, results):
+            if isinstance(result, Exception):
+                log(f"{filename}: {type(result).__name__}: {result}")
+                newManifest.pop(filename, None)
+                failed += 1
+                continue
+            _writeAtomically(os.path.join(outputDir, filename), result.encode("utf-8"))
+            newManifest[filename] = key
+            written.append(filename)
+    if prune:
+        _pruneOutputs(diagrams, outputDir, formats, newManifest, log)
+    if newManifest != manifest:
+        _writeAtomically(manifestPath, json.dumps(newManifest, indent=1, sort_keys=True).encode("utf-8"))
+    return written, skipped, failed
+
+
+def _pruneOutputs(
+    diagrams: Dict[str, Diagram], outputDir: str, formats: Seq[str], manifest: Dict[str, str], log: Callable[[str], Any]
+) -> None:
+    # Delete the outputs, in these formats, that the manifest lists for diagrams that aren't in `diagrams`
+    # (because they were renamed, or removed from their input), and drop them from the manifest.
+    # Only files the manifest names directly in outputDir are touched.
+    current = {_outputName(name) + OUTPUT_EXTENSIONS[format] for name in diagrams for format in formats}
+    extensions = tuple(OUTPUT_EXTENSIONS[format] for format in formats)
+    removed = []
+    for filename in list(manifest):
+        if filename in current or not filename.endswith(extensions) or os.path.basename(filename) != filename:
+            continue
+        try:
+            os.remove(os.path.join(outputDir, filename))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            log(f"{filename}: couldn't remove the outdated output: {err}")
+            continue
+        del manifest[filename]
+        removed.append(filename)
+    if removed:
+        log(f"Removed {', '.join(sorted(removed))}, whose diagrams are gone.")
+
+
+def _outputName(name: str) -> str:
+    # A filename-safe version of a diagram's name.
+    # Names that had to be changed get a hash of the original name added,
+    # so "a b" and "a_b" don't end up in the same file.
+    safe = re.sub(r"[^\w.-]", "_", name).lstrip(".")
+    if safe != name:
+        safe += "-" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return safe
+
+
+def _writeAtomically(path: str, data: bytes) -> None:
+    # Write to a temporary file and rename it into place,
+    # so readers never see a partly-written file.
+    tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tempPath, "wb") as fh:
+            fh.write(data)
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+class RenderCache:
+    """
+    Rendered output kept in memory, evicting the least-recently-used entries
+    once there are more than maxEntries of them, or they total more than maxBytes (of UTF-8).
+    Pass one as the `cache` to render() or a Diagram's write methods.
+    It's safe to share between threads.
+    """
+
+    def __init__(self, maxEntries: int = 1024, maxBytes: int = 64 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries: collections.OrderedDict[str, Tuple[str, int]] = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Sent to renderMany()'s workers as an empty cache with the same limits,
+        # since memory isn't shared between processes anyway.
+        return {"maxEntries": self.maxEntries, "maxBytes": self.maxBytes}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["maxEntries"], state["maxBytes"])  # type: ignore[misc]  # pylint: disable=unnecessary-dunder-call
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Opt[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: str) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.size -= evictedSize
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        # The counters and current size, for exporting to monitoring.
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    """
+    Rendered output stored on disk, as one file per key under `directory`,
+    so it survives across processes and builds.
+    Pass one as the `cache` to render(), renderMany(), or a Diagram's write methods.
+
+    Entries are written atomically, so concurrent processes can share a directory.
+    Reading an entry refreshes its modification time,
+    and whenever the directory grows past maxBytes,
+    the least-recently-used entries are deleted until it's back under 90% of that.
+    """
+
+    def __init__(self, directory: str, maxBytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Sent to renderMany()'s workers with fresh counters; the directory is what's shared.
+        return {"directory": self.directory, "maxBytes": self.maxBytes}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["directory"], state["maxBytes"])  # type: ignore[misc]  # pylint: disable=unnecessary-dunder-call
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Opt[str]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            value = data.decode("utf-8")
+        except UnicodeDecodeError:
+            # A corrupt entry (written by something else, or damaged on disk) is dropped, and counts as a miss.
+            try:
+                os.remove(path)
+                self.size -= len(data)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        data = value.encode("utf-8")
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # An existing entry is replaced, so only the difference in size is added.
+        try:
+            oldSize = os.stat(path).st_size
+        except OSError:
+            oldSize = 0
+        _writeAtomically(path, data)
+        self.size += len(data) - oldSize
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def evict(self) -> None:
+        # Rescan, since other processes may have added or removed entries too.
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        # (mtime, path, size) for every entry.
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+
+def buildCommand(argv: Seq[str]) -> int:
+    """
+    The `python -m railroad build` command: parse the arguments and run buildDiagrams().
+    Returns the exit status.
+    """
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog="python -m railroad build",
+        description="Render every diagram in some JSON or EBNF grammar files, one file per diagram.",
+    )
+    parser.add_argument("inputs", nargs="+", metavar="INPUT", help="A .json diagram file, or an EBNF grammar.")
+    parser.add_argument("-o", "--output", default=".", help="The directory to write into. (Default: the current directory.)")
+    parser.add_argument(
+        "-f",
+        "--format",
+        action="append",
+        choices=RENDER_FORMATS,
+        help="An output format; can be given more than once. (Default: standalone.)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="How many processes to render with. (Default: one per CPU.)")
+    parser.add_argument("--href", default="#{}", help="Link for references between EBNF productions, with {} for the name. (Default: #{})")
+    parser.add_argument("--force", action="store_true", help="Re-render everything, even if it's unchanged since the last build.")
+    parser.add_argument("--watch", action="store_true", help="After building, keep watching the inputs, and rebuild whatever changes.")
+    parser.add_argument("--interval", type=float, default=0.2, help="How often --watch checks the inputs, in seconds. (Default: 0.2.)")
+    parser.add_argument("--cache", metavar="DIR", help="A directory to cache rendered output in, shared between builds.")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB", help="The most the cache can hold. (Default: 256.)")
+    args = parser.parse_args(argv)
+
+    # Text output goes to plain files, not into HTML.
+    global ESCAPE_HTML  # pylint: disable=global-statement
+    ESCAPE_HTML = False
+
+    def log(message: str) -> None:
+        sys.stderr.write(f"{message}\n")
+
+    cache = DiskCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None
+    if args.watch:
+        try:
+            watchDiagrams(
+                args.inputs,
+                args.output,
+                formats=args.format or ["standalone"],
+                jobs=args.jobs,
+                href=args.href or None,
+                log=log,
+                cache=cache,
+                interval=args.interval,
+            )
+        except KeyboardInterrupt:
+            pass
+        return 0
+    rendered, skipped, failed = buildDiagrams(
+        args.inputs,
+        args.output,
+        formats=args.format or ["standalone"],
+        jobs=args.jobs,
+        href=args.href or None,
+        force=args.force,
+        log=log,
+        cache=cache,
+    )
+    log(f"Rendered {rendered} files, skipped {skipped} unchanged, {failed} failed.")
+    return 1 if failed else 0
+
+
 if __name__ == "__main__":
 
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        sys.exit(buildCommand(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        # The service is in its own module, so importing this one doesn't import http.server.
+        import railroad_service
+
+        sys.exit(railroad_service.serveCommand(sys.argv[2:]))
+
     if len(sys.argv) < 2 or sys.argv[1] == "":
         mode = "svg"
     elif sys.argv[1].lower() in ["svg", "ascii", "unicode", "standalone"]:
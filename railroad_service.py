@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# An HTTP service that renders railroad diagrams: see RenderService.
+# It's kept out of railroad.py so that importing that doesn't import http.server.
+from __future__ import annotations
+
+import argparse
+import collections
+import http.server
+import sys
+import threading
+import time
+import urllib.parse
+
+import railroad
+from railroad import (
+    RENDER_FORMATS,
+    Budget,
+    BudgetExceeded,
+    Diagram,
+    RenderCache,
+    fromJson,
+    fromRepr,
+    render,
+    renderKey,
+)
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Dict,
+        Optional as Opt,
+        Sequence as Seq,
+        Tuple,
+    )
+
+
+class RenderService(http.server.ThreadingHTTPServer):
+    """
+    A small HTTP service that renders diagrams, built on the standard library's threaded HTTP server.
+
+    POST a diagram to /render (or /render?format=FORMAT, with any of RENDER_FORMATS),
+    as JSON (see fromJson()) or as constructor syntax (see fromRepr()),
+    and get back the rendered output.
+    Responses carry an ETag from the diagram's renderKey(),
+    so a request with a matching If-None-Match gets a 304 without rendering anything.
+    GET /metrics returns request, rendering, and cache counters in Prometheus's text format.
+
+    Connections are kept alive between requests, and each request is limited to
+    maxBodyBytes of input, maxDepth levels of nesting, and maxNodes items.
+    Parsing and rendering are also done under a Budget,
+    by default enforcing the same maxDepth and maxNodes;
+    a request that goes over it gets a 413.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 8000),
+        cache: Opt[RenderCache] = None,
+        maxBodyBytes: int = 1024 * 1024,
+        maxDepth: int = 100,
+        maxNodes: int = 10_000,
+        quiet: bool = False,
+        budget: Opt[Budget] = None,
+    ):
+        self.cache = cache if cache is not None else RenderCache()
+        self.maxBodyBytes = maxBodyBytes
+        self.maxDepth = maxDepth
+        self.maxNodes = maxNodes
+        self.budget = budget if budget is not None else Budget(maxNodes=maxNodes, maxDepth=maxDepth)
+        self.quiet = quiet
+        self.metricsLock = threading.Lock()
+        self.responses: collections.Counter[int] = collections.Counter()
+        self.renderSeconds = 0.0
+        self.bytesSent = 0
+        http.server.ThreadingHTTPServer.__init__(self, address, RenderRequestHandler)
+
+    def record(self, status: int, bytesSent: int = 0, renderSeconds: float = 0.0) -> None:
+        with self.metricsLock:
+            self.responses[status] += 1
+            self.bytesSent += bytesSent
+            self.renderSeconds += renderSeconds
+
+    def metrics(self) -> str:
+        with self.metricsLock:
+            lines = [
+                "# TYPE railroad_responses_total counter",
+                *(f'railroad_responses_total{{status="{status}"}} {count}' for status, count in sorted(self.responses.items())),
+                "# TYPE railroad_render_seconds_total counter",
+                f"railroad_render_seconds_total {self.renderSeconds}",
+                "# TYPE railroad_response_bytes_total counter",
+                f"railroad_response_bytes_total {self.bytesSent}",
+            ]
+        stats = self.cache.stats()
+        for name in ("hits", "misses", "evictions"):
+            lines += [f"# TYPE railroad_cache_{name}_total counter", f"railroad_cache_{name}_total {stats[name]}"]
+        for name in ("entries", "bytes"):
+            lines += [f"# TYPE railroad_cache_{name} gauge", f"railroad_cache_{name} {stats[name]}"]
+        return "\n".join(lines) + "\n"
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: RenderService
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are closed after this many seconds.
+    timeout = 30
+
+    CONTENT_TYPES = {
+        "svg": "text/html; charset=utf-8",
+        "standalone": "image/svg+xml; charset=utf-8",
+        "ascii": "text/plain; charset=utf-8",
+        "unicode": "text/plain; charset=utf-8",
+    }
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if urllib.parse.urlsplit(self.path).path == "/metrics":
+            self.respond(200, self.server.metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.respond(404, "Not found.\n")
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/render":
+            self.discardBody()
+            self.respond(404, "Not found.\n")
+            return
+        format = urllib.parse.parse_qs(url.query).get("format", ["svg"])[-1]
+        if format not in RENDER_FORMATS:
+            self.discardBody()
+            self.respond(400, f"Unknown format {format!r}; expected one of {', '.join(RENDER_FORMATS)}.\n")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            self.respond(411, "A Content-Length is required.\n")
+            return
+        if length < 0:
+            # There's no telling where the body ends, so the connection can't be reused.
+            self.close_connection = True
+            self.respond(400, "The Content-Length can't be negative.\n")
+            return
+        if length > self.server.maxBodyBytes:
+            # The body isn't read, so the connection can't be reused.
+            self.close_connection = True
+            self.respond(413, f"The diagram is more than {self.server.maxBodyBytes} bytes.\n")
+            return
+        body = self.rfile.read(length).decode("utf-8", errors="replace")
+        try:
+            with self.server.budget.enforce():
+                if body.lstrip().startswith("{"):
+                    item = fromJson(body, maxDepth=self.server.maxDepth, maxNodes=self.server.maxNodes)
+                else:
+                    item = fromRepr(body, maxDepth=self.server.maxDepth, maxNodes=self.server.maxNodes)
+                diagram = item if isinstance(item, Diagram) else Diagram(item)
+                etag = f'"{renderKey(diagram, format)}"'
+        except BudgetExceeded as err:
+            self.respond(413, f"{err}\n")
+            return
+        except ValueError as err:
+            self.respond(400, f"{err}\n")
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            # The parsers should only raise ValueError, but a bad request mustn't take down the connection.
+            self.respond(400, f"Couldn't read the diagram: {type(err).__name__}: {err}\n")
+            return
+        tags = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        if etag in tags or f"W/{etag}" in tags or "*" in tags:
+            self.respond(304, "", extraHeaders={"ETag": etag})
+            return
+        start = time.perf_counter()
+        try:
+            with self.server.budget.enforce():
+                output = render(diagram, format, cache=self.server.cache)
+        except BudgetExceeded as err:
+            self.respond(413, f"{err}\n")
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            self.respond(500, f"Couldn't render the diagram: {type(err).__name__}: {err}\n")
+            return
+        self.respond(200, output, self.CONTENT_TYPES[format], {"ETag": etag}, time.perf_counter() - start)
+
+    def discardBody(self) -> None:
+        # Read an unwanted body, so the connection can be reused.
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            length = 0
+        if 0 < length <= self.server.maxBodyBytes:
+            self.rfile.read(length)
+        elif length:
+            self.close_connection = True
+
+    def respond(
+        self,
+        status: int,
+        text: str,
+        contentType: str = "text/plain; charset=utf-8",
+        extraHeaders: Opt[Dict[str, str]] = None,
+        renderSeconds: float = 0.0,
+    ) -> None:
+        data = text.encode("utf-8")
+        # Record the response before sending it, so it's counted by the time the client sees it.
+        self.server.record(status, len(data), renderSeconds)
+        self.send_response(status)
+        for name, value in (extraHeaders or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(data)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(data)
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        if not self.server.quiet:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def serveCommand(argv: Seq[str]) -> int:
+    """
+    The `python -m railroad serve` command (or `python -m railroad_service`):
+    run a RenderService until interrupted.
+    """
+    parser = argparse.ArgumentParser(prog="python -m railroad serve", description="Run an HTTP service that renders diagrams.")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on. (Default: 127.0.0.1.)")
+    parser.add_argument("--port", type=int, default=8000, help="The port to listen on. (Default: 8000.)")
+    parser.add_argument("--max-body", type=int, default=1024 * 1024, metavar="BYTES", help="The largest request body to accept.")
+    parser.add_argument("--max-depth", type=int, default=100, help="The deepest nesting of items to accept.")
+    parser.add_argument("--max-nodes", type=int, default=10_000, help="The most items to accept in one diagram.")
+    parser.add_argument("--cache-entries", type=int, default=1024, help="How many rendered diagrams to keep in memory.")
+    parser.add_argument("--quiet", action="store_true", help="Don't log each request.")
+    args = parser.parse_args(argv)
+
+    # Text output is served as text/plain, not into HTML.
+    railroad.ESCAPE_HTML = False
+
+    service = RenderService(
+        (args.host, args.port),
+        cache=RenderCache(maxEntries=args.cache_entries),
+        maxBodyBytes=args.max_body,
+        maxDepth=args.max_depth,
+        maxNodes=args.max_nodes,
+        quiet=args.quiet,
+    )
+    sys.stderr.write(f"Serving on http://{args.host}:{service.server_address[1]}/render\n")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(serveCommand(sys.argv[1:]))
@@ -7,7 +7,7 @@ with open("semver.txt", "r") as fh:
 
 setup(
     name='railroad-diagrams',
-    py_modules=['railroad'],
+    py_modules=['railroad', 'railroad_service'],
     version=semver,
     description='Generate SVG railroad syntax diagrams, like on JSON.org.',
     long_description=long_description,
@@ -0,0 +1,937 @@
+# -*- coding: utf-8 -*-
+# Checks for railroad.py's newer features, starting with the parsers that accept untrusted input.
+# Run with `python -m pytest test_railroad.py`.
+
+import asyncio
+import concurrent.futures
+import http.client
+import os
+import pickle
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import railroad
+import railroad_service
+from railroad import (
+    AlternatingSequence,
+    Choice,
+    Comment,
+    Diagram,
+    Group,
+    HorizontalChoice,
+    MultipleChoice,
+    NonTerminal,
+    OneOrMore,
+    Optional,
+    OptionalSequence,
+    Sequence,
+    Skip,
+    Stack,
+    Start,
+    Terminal,
+    ZeroOrMore,
+)
+
+
+def diagrams():
+    return [
+        Diagram(Sequence("a", Choice(1, "b", NonTerminal("c", href="#c", title="see c", cls="ref"), "d"))),
+        Diagram(Stack(Optional("x", skip=True), ZeroOrMore("y", Comment("sep"))), type="complex"),
+        Diagram(MultipleChoice(1, "all", "p", "q", "r"), OptionalSequence("s", "t")),
+        Diagram(Group(OneOrMore(Terminal("it's \"quoted\" \\ é"), "-"), "group label")),
+        Diagram(AlternatingSequence("u", "v")),
+        Diagram(Start(label="labeled"), "w"),
+    ]
+
+
+def svg(item):
+    chunks = []
+    (item if isinstance(item, Diagram) else Diagram(item)).writeSvg(chunks.append)
+    return "".join(chunks)
+
+
+@pytest.mark.parametrize("diagram", diagrams())
+def testJsonRoundTrip(diagram):
+    assert svg(railroad.fromJson(diagram.toJson())) == svg(diagram)
+
+
+@pytest.mark.parametrize("diagram", diagrams())
+def testReprRoundTrip(diagram):
+    # repr() leaves out explicit Starts and Ends, so compare it instead of the output.
+    assert repr(railroad.fromRepr(repr(diagram))) == repr(diagram)
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "",
+        "Sequence(",
+        "Sequence('a',,)",
+        "Sequence()",
+        "HorizontalChoice()",
+        "OptionalSequence()",
+        "Diagram()",
+        "Group()",
+        "Optional()",
+        "AlternatingSequence('a')",
+        "AlternatingSequence('a', 'b', 'c')",
+        "Choice(-1, 'a')",
+        "Choice(1, 'a')",
+        "MultipleChoice(0, 'some', 'a')",
+        "Terminal('\\x')",
+        "Terminal('\\N{foo}')",
+        "Terminal(1)",
+        "Terminal('a', bogus='b')",
+        "Terminal('a', text='b')",
+        "__import__('os')",
+        "Sequence('a').__class__",
+        "Sequence(" * 600 + "'a'" + ")" * 600,
+    ],
+)
+def testReprRejectsMalformedInput(source):
+    with pytest.raises(ValueError):
+        railroad.fromRepr(source)
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "",
+        "[]",
+        '{"kind": "Bogus"}',
+        '{"kind": "Sequence", "items": []}',
+        '{"kind": "Choice", "default": -1, "items": [{"kind": "Skip"}]}',
+        '{"kind": "Choice", "default": 1, "items": [{"kind": "Skip"}]}',
+        '{"kind": "Choice", "default": true, "items": [{"kind": "Skip"}]}',
+        '{"kind": "MultipleChoice", "type": "some", "items": [{"kind": "Skip"}]}',
+        '{"kind": "AlternatingSequence", "items": [{"kind": "Skip"}]}',
+        '{"kind": "Group"}',
+        '{"kind": "Terminal", "text": 1}',
+        '{"kind": "Terminal", "text": "a", "href": []}',
+        '{"kind": "Group", "item": ' * 600 + '{"kind": "Skip"}' + "}" * 600,
+    ],
+)
+def testJsonRejectsMalformedInput(source):
+    with pytest.raises(ValueError):
+        railroad.fromJson(source)
+
+
+def testNodeLimits():
+    source = "Sequence(" + ", ".join(["'a'"] * 20) + ")"
+    with pytest.raises(ValueError):
+        railroad.fromRepr(source, maxNodes=10)
+    with pytest.raises(ValueError):
+        railroad.fromJson(railroad.fromRepr(source).toJson(), maxNodes=10)
+
+
+@pytest.fixture(scope="module")
+def service():
+    server = railroad_service.RenderService(("127.0.0.1", 0), maxNodes=50, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, headers=None):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request("POST", "/render", body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.getheader("ETag"), response.read()
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("diagram", diagrams())
+def testServiceRenders(service, diagram):
+    status, etag, body = post(service, diagram.toJson())
+    assert status == 200
+    assert body.decode("utf-8") == svg(diagram)
+    assert post(service, diagram.toJson(), {"If-None-Match": etag})[0] == 304
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "Sequence()",
+        "Terminal('\\x')",
+        '{"kind": "Choice", "default": -1, "items": [{"kind": "Skip"}]}',
+        "Sequence(" * 600 + "'a'" + ")" * 600,
+    ],
+)
+def testServiceRejectsMalformedInput(service, source):
+    rejected = service.responses[400]
+    assert post(service, source)[0] == 400
+    assert service.responses[400] == rejected + 1
+
+
+def sendHeaders(server, length):
+    # Send only the headers, since the service answers without reading an unacceptable body.
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.putrequest("POST", "/render")
+        connection.putheader("Content-Length", length)
+        connection.endheaders()
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def testServiceLimits(service):
+    assert post(service, "Sequence(" + ", ".join(["'a'"] * 60) + ")")[0] in (400, 413)
+    assert sendHeaders(service, str(service.maxBodyBytes + 1)) == 413
+    # A negative length mustn't be read as "until the connection closes".
+    assert sendHeaders(service, "-1") == 400
+
+
+@pytest.mark.parametrize(
+    "budget",
+    [
+        railroad.Budget(maxNodes=50),
+        railroad.Budget(maxDepth=10),
+        railroad.Budget(maxBytes=1000),
+    ],
+)
+def testTextLayoutBudget(budget):
+    # Built before the budget, so it's only caught while being laid out as text.
+    item = Terminal("a")
+    for _ in range(20):
+        item = Group(Sequence(item, "b", "c"))
+    diagram = Diagram(item)
+    with pytest.raises(railroad.BudgetExceeded):
+        with budget.enforce():
+            diagram.writeText(lambda text: None)
+
+
+def testRegexCacheIsBudgeted():
+    railroad.fromRegex("(a|b|c)+d")
+    with pytest.raises(railroad.BudgetExceeded):
+        with railroad.Budget(maxNodes=3).enforce():
+            railroad.fromRegex("(a|b|c)+d")
+
+
+def testTransformSharesNothing():
+    def build():
+        return Diagram(Sequence("a", Choice(1, "b", Group(NonTerminal("c"), "label")), OneOrMore("d", "e")))
+
+    original = build()
+    renamed = original.transform(lambda item: Terminal("z") if isinstance(item, Terminal) and item.text == "b" else None)
+    expected = svg(build().transform(lambda item: Terminal("z") if isinstance(item, Terminal) and item.text == "b" else None))
+    svg(original)
+    assert svg(renamed) == expected
+    assert svg(original) == svg(build())
+
+
+def testTransformPrune():
+    diagram = Diagram(Sequence("a", Group(Sequence("a", "b"))))
+    upper = diagram.transform(
+        lambda item: Terminal(item.text.upper()) if isinstance(item, Terminal) else None,
+        prune=lambda item: isinstance(item, Group),
+    )
+    assert repr(upper) == repr(Diagram(Sequence("A", Group(Sequence("a", "b")))))
+
+
+def language(item, repeats=2):
+    # Every sequence of terminal and nonterminal texts the item matches,
+    # going around each loop at most `repeats` times.
+    if isinstance(item, (Terminal, NonTerminal)):
+        return {(item.text,)}
+    if isinstance(item, (Choice, HorizontalChoice)):
+        return set().union(*(language(child, repeats) for child in item.items))
+    if isinstance(item, (Diagram, Sequence, Stack)):
+        result = {()}
+        for child in item.items:
+            result = {a + b for a in result for b in language(child, repeats)}
+        return result
+    if isinstance(item, OneOrMore):
+        once = language(item.item, repeats)
+        between = {a + b for a in language(item.rep, repeats) for b in once}
+        result = set(once)
+        for _ in range(repeats):
+            result |= {a + b for a in result for b in between}
+        return result
+    if isinstance(item, Group):
+        return language(item.item, repeats)
+    # Skips, Comments, Starts and Ends.
+    return {()}
+
+
+def messy():
+    return Diagram(
+        Sequence(
+            Sequence("a", Skip(), Sequence("b")),
+            Choice(0, Choice(1, "c", "d"), "c", Optional(Optional("e"))),
+            Choice(0, Sequence("f", "g"), Sequence("f", "h"), "i"),
+            ZeroOrMore(Sequence("j"), Skip()),
+        )
+    )
+
+
+def testNormalize():
+    expected = Diagram(
+        Sequence(
+            "a",
+            "b",
+            Choice(1, "c", "d", Skip(), "e"),
+            Choice(0, Sequence("f", "g"), Sequence("f", "h"), "i"),
+            ZeroOrMore("j", Skip()),
+        )
+    )
+    assert repr(messy().normalize()) == repr(expected)
+    assert svg(messy().normalize()) == svg(expected)
+
+
+def testNormalizeLeftFactor():
+    assert repr(Choice(0, Sequence("a", "b"), Sequence("a", "c")).normalize(leftFactor=True)) == repr(
+        Sequence("a", Choice(0, "b", "c"))
+    )
+
+
+@pytest.mark.parametrize("leftFactor", [False, True])
+def testNormalizeKeepsLanguage(leftFactor):
+    assert language(messy().normalize(leftFactor=leftFactor)) == language(messy())
+
+
+def testNormalizeAfterRendering():
+    source = messy()
+    svg(source)
+    assert svg(source.normalize()) == svg(messy().normalize())
+
+
+def testRegexResultsAreSeparate():
+    first = railroad.fromRegex("ab+c")
+    first.format(paddingTop=50)
+    svg(first)
+    second = railroad.fromRegex("ab+c")
+    assert second is not first
+    assert svg(second) == svg(railroad.fromRegex("ab+c"))
+    assert second.attrs.get("width") != first.attrs["width"]
+
+
+def testConcurrentAsyncRenders():
+    def build():
+        return Diagram(Sequence(*[Choice(0, f"a{i}", f"b{i}", Optional(f"c{i}")) for i in range(20)]))
+
+    formats = ["standalone", "svg", "ascii"] * 3
+    expected = {format: railroad.render(build(), format) for format in set(formats)}
+
+    async def gather(diagram, executor):
+        return await asyncio.gather(*(railroad.renderAsync(diagram, format, executor) for format in formats))
+
+    with concurrent.futures.ThreadPoolExecutor(len(formats)) as executor:
+        for _ in range(10):
+            results = asyncio.run(gather(build(), executor))
+            assert results == [expected[format] for format in formats]
+
+
+@pytest.fixture(params=["python", "numpy"])
+def bulkPath(request, monkeypatch):
+    # fromItems() uses NumPy when it's installed, and plain Python otherwise; check both.
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(railroad, "_numpy", lambda: None)
+    return request.param
+
+
+def bulkItems():
+    return [Terminal(f"t{i}" * (i % 4 + 1)) if i % 3 else Optional(NonTerminal(f"n{i}")) for i in range(40)]
+
+
+def assertSameItem(bulk, built):
+    assert type(bulk) is type(built)
+    for name in ("width", "up", "height", "down", "needsSpace"):
+        assert getattr(bulk, name) == pytest.approx(getattr(built, name)), name
+    assert svg(bulk) == svg(built)
+
+
+def testSequenceFromItems(bulkPath):
+    assertSameItem(Sequence.fromItems(iter(bulkItems())), Sequence(*bulkItems()))
+
+
+def testStackFromItems(bulkPath):
+    assertSameItem(Stack.fromItems(iter(bulkItems())), Stack(*bulkItems()))
+
+
+@pytest.mark.parametrize("default", [0, 1, 20, 39])
+def testChoiceFromItems(bulkPath, default):
+    assertSameItem(Choice.fromItems(default, iter(bulkItems())), Choice(default, *bulkItems()))
+
+
+def testFromItemsWithFloatSpacing(bulkPath, monkeypatch):
+    # Float measurements could add up differently in bulk, so these are built item-by-item.
+    monkeypatch.setattr(railroad, "VS", 8.3)
+    assertSameItem(Sequence.fromItems(bulkItems()), Sequence(*bulkItems()))
+    assertSameItem(Stack.fromItems(bulkItems()), Stack(*bulkItems()))
+    assertSameItem(Choice.fromItems(7, bulkItems()), Choice(7, *bulkItems()))
+
+
+def testDiskCacheOverwrite(tmp_path):
+    cache = railroad.DiskCache(str(tmp_path), maxBytes=250)
+    for _ in range(5):
+        cache.put("ab" * 20, "x" * 100)
+    assert cache.size == 100
+    assert cache.evictions == 0
+    assert cache.get("ab" * 20) == "x" * 100
+
+
+def testDiskCacheCorruptEntry(tmp_path):
+    cache = railroad.DiskCache(str(tmp_path))
+    key = "cd" * 20
+    cache.put(key, "ok")
+    with open(cache._path(key), "wb") as fh:
+        fh.write(b"\xff\xfe")
+    assert cache.get(key) is None
+    assert cache.misses == 1
+    assert not os.path.exists(cache._path(key))
+    assert cache.size == 0
+
+
+def writeJson(path, diagrams):
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write("{" + ", ".join(f'"{name}": {diagram.toJson()}' for name, diagram in diagrams.items()) + "}")
+
+
+def testIncrementalBuild(tmp_path):
+    source = tmp_path / "grammar.json"
+    output = tmp_path / "out"
+    writeJson(source, {"a": Diagram("x"), "b b": Diagram("y")})
+    logs = []
+    build = lambda: railroad.buildDiagrams([str(source)], str(output), formats=["standalone", "ascii"], jobs=1, log=logs.append)
+    assert build() == (4, 0, 0)
+    assert build() == (0, 4, 0)
+    assert (output / "a.svg").read_text(encoding="utf-8") == railroad.render(Diagram("x"), "standalone")
+
+    writeJson(source, {"a": Diagram("changed"), "c": Diagram("z")})
+    assert build() == (4, 0, 0)
+    assert sorted(path.name for path in output.iterdir() if not path.name.startswith(".")) == [
+        "a.ascii.txt",
+        "a.svg",
+        "c.ascii.txt",
+        "c.svg",
+    ]
+
+
+def testBuildKeepsOutputsOfFailedInputs(tmp_path):
+    good = tmp_path / "good.json"
+    bad = tmp_path / "bad.json"
+    output = tmp_path / "out"
+    writeJson(good, {"a": Diagram("x")})
+    writeJson(bad, {"b": Diagram("y")})
+    assert railroad.buildDiagrams([str(good), str(bad)], str(output), jobs=1, log=lambda message: None) == (2, 0, 0)
+    bad.write_text("{", encoding="utf-8")
+    assert railroad.buildDiagrams([str(good), str(bad)], str(output), jobs=1, log=lambda message: None) == (0, 1, 1)
+    assert (output / "b.svg").exists()
+
+
+def grammar():
+    return {
+        "expr": Diagram(NonTerminal("term", href="#term"), ZeroOrMore(Sequence(Terminal("+"), NonTerminal("term", href="#term")))),
+        "term": Diagram(Choice(0, NonTerminal("number", cls="leaf"), Sequence("(", NonTerminal("expr", href="#expr"), ")"))),
+        "number": Diagram(OneOrMore(Terminal("digit", cls="leaf char"))),
+    }
+
+
+def paths(found):
+    return {name: [visit.path for visit in visits] for name, visits in found.items()}
+
+
+def testDiagramIndexLookups():
+    diagrams = grammar()
+    index = railroad.DiagramIndex(diagrams)
+    assert paths(index.withText("term")) == {"expr": [(1,), (2, 1, 0, 1)]}
+    for visit in index.withText("term")["expr"]:
+        item = diagrams["expr"]
+        for step in visit.path:
+            item = item._subItems()[step]
+        assert item is visit.item
+    assert set(index.withHref("#expr")) == {"term"}
+    assert set(index.withClass("leaf")) == {"term", "number"}
+    assert set(index.withClass("char")) == {"number"}
+    assert index.withText("missing") == {}
+    assert sorted(index.usedBy("term")) == ["expr"]
+    assert sorted(index.usedBy("expr")) == ["term"]
+    assert sorted(index.uses("term")) == ["expr", "number"]
+    assert index.uses("number") == []
+
+
+def testDiagramIndexResultsAreCopies():
+    index = railroad.DiagramIndex(grammar())
+    for lookup, key in [(index.withText, "term"), (index.withHref, "#term"), (index.withClass, "leaf")]:
+        before = paths(lookup(key))
+        found = lookup(key)
+        for visits in found.values():
+            visits.clear()
+        found["other"] = []
+        assert paths(lookup(key)) == before
+    index.usedBy("term").append("other")
+    assert index.usedBy("term") == ["expr"]
+
+
+def testDiagramIndexUpdates():
+    index = railroad.DiagramIndex(grammar())
+    index.add("term", Diagram(NonTerminal("number")))
+    assert index.usedBy("expr") == []
+    assert index.withHref("#expr") == {}
+    assert index.uses("term") == ["number"]
+    index.remove("expr")
+    index.remove("expr")
+    assert index.usedBy("term") == []
+    assert index.withText("+") == {}
+    assert set(index.diagrams) == {"term", "number"}
+    assert index.texts.keys() == {"number", "digit"}
+
+
+def words():
+    return ["select", NonTerminal("columns"), "from", NonTerminal("table"), Optional(Sequence("where", NonTerminal("condition"))), Choice(0, "asc", "desc"), ";"]
+
+
+@pytest.mark.parametrize("maxWidth", [340, 400, 500, 700, 1000])
+def testFitToWidth(maxWidth):
+    diagram = Diagram.fitToWidth(maxWidth, *words())
+    width, _, _ = diagram.measure()
+    assert width <= maxWidth
+    assert language(diagram) == language(Diagram(*words()))
+    diagram.format()
+    assert float(diagram.attrs["width"]) == width
+
+
+def testFitToWidthOneLine():
+    assert repr(Diagram.fitToWidth(10000, *words())) == repr(Diagram(*words()))
+    assert repr(Diagram.fitToWidth(10000, Sequence(*words()), type="complex")) == repr(Diagram(Sequence(*words()), type="complex"))
+
+
+def testFitToWidthBreaksTopLevelSequences():
+    diagram = Diagram.fitToWidth(400, Sequence(*words()))
+    assert isinstance(diagram.items[1], Stack)
+    assert diagram.measure()[0] <= 400
+
+
+def testFitToWidthTooNarrow():
+    # The Optional can't fit in 300px, so it gets a row to itself, and every other row fits.
+    rows = Diagram.fitToWidth(300, *words()).items[1].items
+    assert [row for row in rows if isinstance(row, Choice)] == [rows[3]]
+    for row in rows[:3] + rows[4:]:
+        assert Diagram(Stack(row, row)).measure()[0] <= 300
+
+
+def testFitToWidthHorizontalChoices():
+    items = ["a", Choice(0, "one", "two", "three", "four"), "b"]
+    plain = Diagram.fitToWidth(1000, *items)
+    horizontal = Diagram.fitToWidth(1000, *items, horizontalChoices=True)
+    assert isinstance(horizontal.items[2], HorizontalChoice)
+    assert horizontal.measure()[1] < plain.measure()[1]
+    assert language(horizontal) == language(plain)
+    narrow = Diagram.fitToWidth(250, *items, horizontalChoices=True)
+    assert narrow.measure()[0] <= 250
+
+
+def shapes(svgText):
+    # The paths, rects and texts an SVG draws, in absolute coordinates,
+    # so that output drawn with and without translate()s can be compared.
+    found = []
+    stack = [(ET.fromstring(svgText.replace("xlink:href", "href")), 0.0, 0.0)]
+    while stack:
+        element, dx, dy = stack.pop()
+        match = re.fullmatch(r"translate\((\S+) (\S+)\)", element.get("transform", "translate(0 0)"))
+        dx, dy = dx + float(match[1]), dy + float(match[2])
+        if element.tag == "path":
+            x, y, *rest = re.findall(r"[a-zA-Z]|-?[\d.]+", element.get("d"))[1:]
+            rest = [token if token.isalpha() else float(token) for token in rest]
+            found.append(("path", float(x) + dx, float(y) + dy, *rest))
+        elif element.tag in ("rect", "text"):
+            found.append((element.tag, float(element.get("x")) + dx, float(element.get("y")) + dy, element.get("width"), element.text))
+        stack.extend((child, dx, dy) for child in element)
+    return sorted(found, key=repr)
+
+
+def formattedSvg(diagram, **kwargs):
+    diagram.format(**kwargs)
+    return svg(diagram)
+
+
+@pytest.mark.parametrize("index", range(len(diagrams())))
+def testFragmentCacheDrawsTheSame(index):
+    plain = formattedSvg(diagrams()[index])
+    cached = formattedSvg(diagrams()[index], cache=railroad.FragmentCache())
+    assert cached != plain
+    assert shapes(cached) == shapes(plain)
+
+
+def testFragmentCacheReuse():
+    cache = railroad.FragmentCache()
+    shared = lambda: Choice(0, "b", Sequence("c", "d"))
+    first = formattedSvg(Diagram("a", shared()), cache=cache)
+    assert (cache.hits, cache.misses) == (0, 8)
+    # Only the "x" is new; the Start, the End, and the whole Choice are reused.
+    second = formattedSvg(Diagram("x", shared()), cache=cache)
+    assert (cache.hits, cache.misses) == (3, 9)
+    assert shapes(first) == shapes(formattedSvg(Diagram("a", shared())))
+    assert shapes(second) == shapes(formattedSvg(Diagram("x", shared())))
+    assert formattedSvg(Diagram("a", shared()), cache=cache) == first
+    assert (cache.hits, cache.misses) == (7, 9)
+
+
+def overlaid(diagram, overlay, write="writeSvg"):
+    chunks = []
+    getattr(diagram, write)(chunks.append, overlay=overlay)
+    return "".join(chunks)
+
+
+def testOverlayPaths():
+    diagram = Diagram(Sequence("a", Choice(1, "b", NonTerminal("c", cls="ref"))), OneOrMore("d", "e"))
+    plain = svg(diagram)
+    choice = diagram.items[1].items[1]
+    byItem = overlaid(diagram, {choice.items[0]: "hit", choice.items[1]: {"class": "hit", "data-n": "2"}, diagram.items[2].rep: "rep"})
+    byPath = overlaid(diagram, {(1, 1, 0): "hit", (1, 1, 1): {"class": "hit", "data-n": "2"}, (2, 1): "rep"})
+    assert byPath == byItem
+    assert byItem.count('class="terminal hit"') == 1
+    assert byItem.count('class="non-terminal ref hit" data-n="2"') == 1
+    assert byItem.count('class="terminal rep"') == 1
+    # Only those elements' attributes change.
+    unmarked = byItem.replace("terminal hit", "terminal ").replace("terminal rep", "terminal ").replace('ref hit" data-n="2"', 'ref"')
+    assert unmarked == plain
+    # Overlaying leaves the diagram as it was.
+    assert svg(diagram) == plain
+
+
+def testOverlayStandalone():
+    diagram = Diagram("a", "b")
+    highlighted = overlaid(diagram, {(2,): "hit"}, "writeStandalone")
+    assert highlighted.count('class="terminal hit"') == 1
+    assert highlighted.replace("terminal hit", "terminal ") == overlaid(diagram, None, "writeStandalone")
+
+
+def testOverlayBypassesRenderCache():
+    diagram = Diagram("a", "b")
+    cache = railroad.RenderCache()
+    plain = []
+    diagram.writeSvg(plain.append, cache=cache)
+    highlighted = []
+    diagram.writeSvg(highlighted.append, overlay={(1,): "hit"}, cache=cache)
+    assert 'class="terminal hit"' in "".join(highlighted)
+    assert len(cache) == 1
+
+
+@pytest.mark.parametrize("path", [(4,), (1, 0), (-1,), (0.5,), ("1",)])
+def testOverlayBadPaths(path):
+    with pytest.raises(ValueError, match="Overlay path"):
+        overlaid(Diagram("a", "b"), {path: "hit"})
+
+
+@pytest.mark.parametrize("padding", [(), (0,), (5, 10, 15, 20)])
+@pytest.mark.parametrize("index", range(len(diagrams())))
+def testMeasure(index, padding):
+    width, height, boxes = diagrams()[index].measure(*padding, boxes=True)
+    diagram = diagrams()[index]
+    diagram.format(*padding)
+    assert (width, height) == (float(diagram.attrs["width"]), float(diagram.attrs["height"]))
+    assert diagrams()[index].measure(*padding) == (width, height, [])
+    assert len(boxes) == sum(1 for _ in diagram.iterate())
+    assert boxes[0][1:] == (diagram.padding[3], diagram.padding[0], diagram.width, diagram.up + diagram.height + diagram.down)
+    # Every Terminal and NonTerminal is drawn as a rect filling its box.
+    measured = sorted(box[1:] for box in boxes if isinstance(box[0], (Terminal, NonTerminal)))
+    drawn = sorted(
+        (float(rect.get("x")), float(rect.get("y")), float(rect.get("width")), float(rect.get("height")))
+        for rect in ET.fromstring(svg(diagram).replace("xlink:href", "href")).iter("rect")
+        if not rect.get("class")
+    )
+    assert measured == drawn
+
+
+def testFromEbnf():
+    grammar = railroad.fromEbnf(
+        """
+        [1] document ::= prolog element Misc*   /* the whole thing */
+        [2] Char ::= #x9 | #xA | [#x20-#xD7FF]
+        prolog ::= XMLDecl? (Misc | "x")+ [ wfc: No External ]
+        element ::= "<" Name - ("xml" | 'XML') ">"
+        Misc ::= Comment
+        """
+    )
+    ref = lambda name: NonTerminal(name, href=f"#{name}")
+    assert list(grammar) == ["document", "Char", "prolog", "element", "Misc"]
+    expected = {
+        "document": Diagram(ref("prolog"), ref("element"), ZeroOrMore(ref("Misc"))),
+        "Char": Diagram(Choice(0, "#x9", "#xA", "[#x20-#xD7FF]")),
+        "prolog": Diagram(Optional(NonTerminal("XMLDecl")), OneOrMore(Choice(0, ref("Misc"), "x"))),
+        "element": Diagram("<", Group(NonTerminal("Name"), "except ( \"xml\" | 'XML' )"), ">"),
+        "Misc": Diagram(NonTerminal("Comment")),
+    }
+    assert {name: repr(diagram) for name, diagram in grammar.items()} == {
+        name: repr(diagram) for name, diagram in expected.items()
+    }
+
+
+def testFromEbnfHref():
+    assert repr(railroad.fromEbnf("a ::= b c\nb ::= 'b'", href=None)["a"]) == repr(Diagram(NonTerminal("b"), NonTerminal("c")))
+    assert railroad.fromEbnf("a ::= b\nb ::= 'b'", href="rules.html#{}")["a"].items[1].href == "rules.html#b"
+
+
+@pytest.mark.parametrize(
+    "source, message",
+    [
+        ("a ::= (b", "Expected ')', but found end of grammar at line 1, column 9"),
+        ("a ::= b\n  )", "but found ')' at line 2, column 3"),
+        ("::= b", "but found '::=' at line 1, column 1"),
+        ("a b", "but found 'a' at line 1, column 1"),
+        ('a ::= "unterminated', "Unexpected character '\"' in EBNF at line 1, column 7"),
+        ("a ::= b ~", "Unexpected character '~'"),
+        ("a ::= " + "(" * 5000 + "b" + ")" * 5000, "Production 'a' is nested too deeply"),
+    ],
+)
+def testFromEbnfErrors(source, message):
+    with pytest.raises(ValueError) as error:
+        railroad.fromEbnf(source)
+    assert message in str(error.value)
+
+
+class Keyword(Terminal):
+    pass
+
+
+@pytest.mark.parametrize("protocol", range(pickle.HIGHEST_PROTOCOL + 1))
+@pytest.mark.parametrize("index", range(len(diagrams())))
+def testPickleRoundTrip(index, protocol):
+    diagram = diagrams()[index]
+    copy = pickle.loads(pickle.dumps(diagram, protocol))
+    assert type(copy) is Diagram and copy is not diagram
+    assert repr(copy) == repr(diagram)
+    assert not copy.formatted
+    assert svg(copy) == svg(diagram)
+
+
+def testPickleFormatted():
+    diagram = diagrams()[0]
+    unformatted = pickle.dumps(diagram)
+    diagram.format(5, 10)
+    formatted = pickle.dumps(diagram)
+    # Only the padding is added, not the geometry.
+    assert len(formatted) < len(unformatted) + 100
+    copy = pickle.loads(formatted)
+    assert copy.formatted and copy.padding == diagram.padding
+    assert svg(copy) == svg(diagram)
+
+
+def testPickleItems():
+    item = Sequence("a", Group(OneOrMore(NonTerminal("b", href="#b"), Comment("sep")), "label"))
+    copy = pickle.loads(pickle.dumps(item))
+    assert repr(copy) == repr(item)
+    assert copy.items[1].item.item is not item.items[1].item.item
+    # Subclasses aren't rebuilt from .toDict(), so they keep their class.
+    keyword = pickle.loads(pickle.dumps(Sequence(Keyword("if"), "x")))
+    assert type(keyword.items[0]) is Keyword and keyword.items[0].text == "if"
+
+
+class Broken(Terminal):
+    def format(self, x, y, width):
+        raise RuntimeError(f"can't draw {self.text}")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def testRenderMany(jobs, monkeypatch):
+    monkeypatch.setattr(railroad, "VS", 12)
+    batch = diagrams() + [Diagram(Broken("x"))] + diagrams()
+    results = railroad.renderMany(batch, "standalone", jobs=jobs, chunksize=2)
+    assert len(results) == len(batch)
+    for diagram, result in zip(batch, results):
+        if isinstance(diagram.items[1], Broken):
+            assert isinstance(result, RuntimeError) and str(result) == "can't draw x"
+        else:
+            assert result == railroad.render(diagram, "standalone")
+
+
+def testRenderManyUnpicklable():
+    unpicklable = Keyword("x")
+    unpicklable.callback = lambda: None
+    results = railroad.renderMany([Diagram("a"), Diagram(unpicklable), Diagram("b")], jobs=2)
+    assert results[0] == railroad.render(Diagram("a")) and results[2] == railroad.render(Diagram("b"))
+    assert isinstance(results[1], Exception)
+
+
+def testRenderManyBadFormat():
+    with pytest.raises(ValueError, match="Unknown render format"):
+        railroad.renderMany([Diagram("a")], "png")
+
+
+def testRenderCacheEvictsLeastRecentlyUsed():
+    cache = railroad.RenderCache(maxEntries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("1", None, "3")
+    cache.put("a", "11")
+    assert cache.stats() == {"entries": 2, "bytes": 3, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def testRenderCacheEvictsByBytes():
+    cache = railroad.RenderCache(maxBytes=10)
+    cache.put("a", "ééé")
+    cache.put("b", "bbbb")
+    assert cache.stats()["bytes"] == 10
+    cache.put("c", "c")
+    assert cache.get("a") is None and len(cache) == 2
+    # Anything bigger than the whole cache isn't stored, and doesn't evict anything.
+    cache.put("d", "d" * 11)
+    assert cache.get("d") is None and len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+
+
+def testRenderCacheOutput(monkeypatch):
+    cache = railroad.RenderCache()
+    for diagram in diagrams():
+        for format in railroad.RENDER_FORMATS:
+            uncached = railroad.render(diagram, format)
+            assert railroad.render(diagram, format, cache) == uncached
+            assert railroad.render(diagram, format, cache) == uncached
+    assert cache.hits == cache.misses == len(cache) == len(diagrams()) * len(railroad.RENDER_FORMATS)
+    # Changing an option that affects the output changes the key.
+    key = railroad.renderKey(diagrams()[0], "svg")
+    monkeypatch.setattr(railroad, "VS", 12)
+    assert railroad.renderKey(diagrams()[0], "svg") != key
+    assert railroad.render(diagrams()[0], "svg", cache) == railroad.render(diagrams()[0], "svg")
+
+
+def testRenderCachePickle():
+    cache = railroad.RenderCache(maxEntries=3, maxBytes=100)
+    cache.put("a", "1")
+    copy = pickle.loads(pickle.dumps(cache))
+    assert (copy.maxEntries, copy.maxBytes, len(copy)) == (3, 100, 0)
+
+
+def testWatchRendersOnlyChangedDiagrams(tmp_path):
+    source = tmp_path / "grammar.ebnf"
+    output = tmp_path / "out"
+    logs = []
+
+    def save(text):
+        # Bump the mtime too, in case the filesystem's clock is coarser than the test.
+        before = source.stat().st_mtime_ns if source.exists() else 0
+        source.write_text(text, encoding="utf-8")
+        os.utime(source, ns=(before + 10**9, before + 10**9))
+
+    def waitFor(count):
+        for _ in range(500):
+            if len(logs) >= count:
+                return logs[count - 1]
+            stop.wait(0.01)
+        raise AssertionError(f"Only got {logs}")
+
+    save("a ::= 'x' b\nb ::= 'y'+\nc ::= a | b\n")
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=railroad.watchDiagrams,
+        args=([str(source)], str(output)),
+        kwargs={"formats": ["standalone", "ascii"], "log": logs.append, "interval": 0.01, "stop": stop},
+    )
+    watcher.start()
+    try:
+        assert waitFor(1) == "Rendered 6 files, skipped 0 unchanged, 0 failed."
+        save("a ::= 'x' b\nb ::= 'z'+\nc ::= a | b\n")
+        assert waitFor(2) == "Updated b.svg, b.ascii.txt."
+        assert "z" in (output / "b.ascii.txt").read_text(encoding="utf-8")
+        # A broken edit is reported, and the last good outputs are kept.
+        save("a ::= 'x' b\nb ::= ( 'z'+\nc ::= a | b\n")
+        assert waitFor(3).startswith(f"{source}: ")
+        assert (output / "b.svg").exists()
+        save("a ::= 'x' b\nb ::= 'z'+\nc ::= a | b | 'w'\n")
+        assert waitFor(4) == "Updated c.svg, c.ascii.txt."
+    finally:
+        stop.set()
+        watcher.join()
+    assert len(logs) == 4
+
+
+def testProfilerCounts():
+    calls = []
+    original = Terminal.__init__
+    with railroad.Profiler(lambda name, phase, seconds: calls.append((name, phase))) as profiler:
+        assert Terminal.__init__ is not original
+        diagram = Diagram(Sequence("a", NonTerminal("b")), Choice(0, "c", Sequence("d")))
+        railroad.render(diagram)
+        railroad.render(diagram, "ascii")
+    assert Terminal.__init__ is original
+    counts = {key: stat[0] for key, stat in profiler.stats.items() if stat[0]}
+    assert {key: counts[key] for key in ("Terminal.__init__", "Terminal.format", "Terminal.textDiagram")} == {
+        "Terminal.__init__": 3,
+        "Terminal.format": 3,
+        "Terminal.textDiagram": 3,
+    }
+    assert counts["Sequence.format"] == counts["Sequence.textDiagram"] == 2
+    assert counts["Diagram.writeSvg"] == counts["Diagram.writeText"] == counts["Diagram.format"] == 1
+    assert len(calls) == sum(counts.values())
+    assert {phase for _, phase in calls} == {"construction", "layout", "serialization", "text"}
+    for phase, (phaseCalls, seconds) in profiler.phases().items():
+        assert phaseCalls == sum(1 for _, callPhase in calls if callPhase == phase)
+        assert seconds > 0
+    for _, own, cumulative, _ in profiler.stats.values():
+        assert own <= cumulative + 1e-9
+    # Each Diagram.format call includes everything it formats.
+    assert profiler.stats["Diagram.format"][2] >= profiler.stats["Sequence.format"][2]
+
+
+def testProfilerDump():
+    with railroad.Profiler() as profiler:
+        railroad.render(Diagram("a", "b"))
+    lines = []
+    profiler.dump(lines.append, sort="calls", limit=2)
+    assert lines[0].split() == ["ncalls", "tottime", "cumtime", "phase", "method"]
+    assert [line.split()[-1] for line in lines[1:3]] == ["DiagramItem.__init__", "DiagramItem.writeSvg"]
+    assert lines[3].startswith("construction: ")
+
+
+def testOneProfilerAtATime():
+    with railroad.Profiler():
+        with pytest.raises(RuntimeError):
+            railroad.Profiler().enable()
+    with railroad.Profiler() as profiler:
+        Terminal("a")
+    assert profiler.stats["Terminal.__init__"][0] == 1
+
+
+
+def testMemoryReport():
+    diagram = Diagram(Sequence("a", NonTerminal("b")), Choice(0, "c", "d"))
+    report = diagram.memoryReport()
+    assert {name: count for name, (count, _) in report["tree"].items()} == {
+        "Diagram": 1, "Start": 1, "Sequence": 1, "Terminal": 3, "NonTerminal": 1, "Choice": 1, "End": 1
+    }
+    assert report["geometry"] == {}
+    assert report["bytes"]["geometry"] == 0
+    assert report["bytes"]["attrs"] > 0
+    diagram.format()
+    formatted = diagram.memoryReport()
+    assert {"Path", "children list"} <= set(formatted["geometry"])
+    assert formatted["bytes"]["geometry"] > formatted["bytes"]["tree"]
+    for each in (report, formatted):
+        sizes = each["bytes"]
+        for part in ("tree", "attrs", "geometry"):
+            assert sizes[part] == sum(size for _, size in each[part].values())
+        assert sizes["total"] == sizes["tree"] + sizes["attrs"] + sizes["geometry"]
+    longer = Diagram(Sequence("a" * 1000, NonTerminal("b")), Choice(0, "c", "d")).memoryReport()
+    assert longer["bytes"]["tree"] >= report["bytes"]["tree"] + 999
+
+
+@pytest.mark.parametrize("index", range(len(diagrams())))
+def testStats(index):
+    diagram = diagrams()[index]
+    stats = diagram.stats()
+    assert diagram.formatted
+    visits = list(diagram.iterate())
+    nodes = {}
+    for visit in visits:
+        nodes[type(visit.item).__name__] = nodes.get(type(visit.item).__name__, 0) + 1
+    assert stats["nodes"] == nodes
+    assert stats["nodeCount"] == len(visits)
+    assert stats["maxDepth"] == max(visit.depth for visit in visits)
+    output = svg(diagram)
+    assert stats["bytes"] == len(output.encode("utf-8"))
+    drawn = ET.fromstring(output.replace("xlink:href", "href")).iter("path")
+    assert stats["pathSegments"] == sum(len(railroad.PATH_COMMANDS.findall(path.get("d"))) for path in drawn)
+    assert (stats["width"], stats["height"]) == diagram.measure()[:2]